@@ -5,9 +5,10 @@ import sqlite3
 from contextlib import asynccontextmanager
 
 import psutil
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from loguru import logger
 
+from competitions import instrumentation
 from competitions.utils import run_evaluation
 
 
@@ -89,6 +90,7 @@ runner = BackgroundRunner()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    instrumentation.setup()
     process_pid = run_evaluation(params=PARAMS)
     logger.info(f"Started training with PID {process_pid}")
     DB.add_job(process_pid)
@@ -107,3 +109,8 @@ async def root():
 @api.get("/health")
 async def health():
     return "OK"
+
+
+@api.get("/metrics")
+def metrics():
+    return Response(instrumentation.render(), media_type=instrumentation.CONTENT_TYPE)
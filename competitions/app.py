@@ -1,25 +1,35 @@
 import datetime
+import hashlib
 import os
 import threading
 import time
+from typing import Literal
 
-from fastapi import Depends, FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi import Depends, FastAPI, File, Form, HTTPException, Query, Request, Response, UploadFile
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from huggingface_hub import hf_hub_download
 from huggingface_hub.utils import disable_progress_bars
 from huggingface_hub.utils._errors import EntryNotFoundError
 from loguru import logger
 from pydantic import BaseModel
 from requests.exceptions import RequestException
 
-from competitions import __version__, utils
-from competitions.errors import AuthenticationError, PastDeadlineError, SubmissionError, SubmissionLimitError
-from competitions.info import CompetitionInfo
+from competitions import __version__, hub, instrumentation, utils
+from competitions.errors import (
+    AuthenticationError,
+    PastDeadlineError,
+    SubmissionError,
+    SubmissionLimitError,
+    SubmissionValidationError,
+)
+from competitions.http_cache import cached_json_response
+from competitions.hub import run_blocking
+from competitions.info import get_competition_info
 from competitions.leaderboard import Leaderboard
 from competitions.oauth import attach_oauth
 from competitions.runner import JobRunner
+from competitions.state import check_state_backend
 from competitions.submissions import Submissions
 from competitions.text import SUBMISSION_SELECTION_TEXT, SUBMISSION_TEXT
 
@@ -30,16 +40,12 @@ COMPETITION_ID = os.environ.get("COMPETITION_ID")
 OUTPUT_PATH = os.environ.get("OUTPUT_PATH", "/tmp/model")
 START_DATE = os.environ.get("START_DATE", "2000-12-31")
 DISABLE_PUBLIC_LB = int(os.environ.get("DISABLE_PUBLIC_LB", 0))
+LEADERBOARD_PAGE_MAX = int(os.environ.get("LEADERBOARD_PAGE_MAX", 500))
 
 disable_progress_bars()
 
 try:
-    REQUIREMENTS_FNAME = hf_hub_download(
-        repo_id=COMPETITION_ID,
-        filename="requirements.txt",
-        token=HF_TOKEN,
-        repo_type="dataset",
-    )
+    REQUIREMENTS_FNAME = hub.download(COMPETITION_ID, "requirements.txt", HF_TOKEN)
 except EntryNotFoundError:
     REQUIREMENTS_FNAME = None
 
@@ -48,6 +54,8 @@ if REQUIREMENTS_FNAME:
     utils.uninstall_requirements(REQUIREMENTS_FNAME)
     utils.install_requirements(REQUIREMENTS_FNAME)
 
+check_state_backend(get_competition_info(COMPETITION_ID, HF_TOKEN).competition_type)
+
 
 class LeaderboardRequest(BaseModel):
     lb: str
@@ -61,13 +69,22 @@ class UpdateTeamNameRequest(BaseModel):
     new_team_name: str
 
 
+# the job runner of the running job runner thread
+job_runner = None
+
+
 def run_job_runner():
+    global job_runner
     job_runner = JobRunner(
         competition_id=COMPETITION_ID,
         token=HF_TOKEN,
         output_path=OUTPUT_PATH,
     )
-    job_runner.run()
+    try:
+        job_runner.run()
+    finally:
+        # the watchdog starts a new runner, with its own workers
+        job_runner.shutdown()
 
 
 def start_job_runner_thread():
@@ -77,16 +94,29 @@ def start_job_runner_thread():
     return thread
 
 
-def watchdog(job_runner_thread):
+def watchdog():
+    global job_runner_thread
     while True:
-        if not job_runner_thread.is_alive():
+        if not job_runner_thread.is_alive() and (job_runner is None or not job_runner.stopped):
             logger.warning("Job runner thread stopped. Restarting...")
             job_runner_thread = start_job_runner_thread()
         time.sleep(10)
 
 
+def stop_job_runner():
+    """Stop the job runner and wait for its thread to end, e.g. for a script using the app to exit."""
+    while job_runner is None and job_runner_thread.is_alive():
+        # the runner is still being created
+        time.sleep(0.1)
+    if job_runner is not None:
+        job_runner.stop()
+    job_runner_thread.join()
+
+
+# the job runner's scoring workers and evaluation processes export their metrics through this process
+instrumentation.setup()
 job_runner_thread = start_job_runner_thread()
-watchdog_thread = threading.Thread(target=watchdog, args=(job_runner_thread,))
+watchdog_thread = threading.Thread(target=watchdog)
 watchdog_thread.daemon = True
 watchdog_thread.start()
 
@@ -109,7 +139,9 @@ async def read_form(request: Request):
     """
     if HF_TOKEN is None:
         return HTTPException(status_code=500, detail="HF_TOKEN is not set.")
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = await run_blocking(
+        get_competition_info, competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN
+    )
     context = {
         "request": request,
         "logo": competition_info.logo_url,
@@ -134,7 +166,9 @@ async def user_logout(request: Request):
     if "oauth_info" in request.session:
         request.session.pop("oauth_info", None)
 
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = await run_blocking(
+        get_competition_info, competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN
+    )
     context = {
         "request": request,
         "logo": competition_info.logo_url,
@@ -148,52 +182,60 @@ async def user_logout(request: Request):
 
 @app.get("/competition_info", response_class=JSONResponse)
 async def get_comp_info(request: Request):
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = await run_blocking(
+        get_competition_info, competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN
+    )
     info = competition_info.competition_desc
     resp = {"response": info}
-    return resp
+    return cached_json_response(request, resp, competition_info.revision, "competition_info")
 
 
 @app.get("/dataset_info", response_class=JSONResponse)
 async def get_dataset_info(request: Request):
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = await run_blocking(
+        get_competition_info, competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN
+    )
     info = competition_info.dataset_desc
     resp = {"response": info}
-    return resp
+    return cached_json_response(request, resp, competition_info.revision, "dataset_info")
 
 
 @app.get("/rules", response_class=JSONResponse)
 async def get_rules(request: Request):
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = await run_blocking(
+        get_competition_info, competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN
+    )
     if competition_info.rules is not None:
-        return {"response": competition_info.rules}
-    return {"response": "No rules available."}
+        resp = {"response": competition_info.rules}
+    else:
+        resp = {"response": "No rules available."}
+    return cached_json_response(request, resp, competition_info.revision, "rules")
 
 
 @app.get("/submission_info", response_class=JSONResponse)
 async def get_submission_info(request: Request):
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = await run_blocking(
+        get_competition_info, competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN
+    )
     info = competition_info.submission_desc
     resp = {"response": info}
-    return resp
+    return cached_json_response(request, resp, competition_info.revision, "submission_info")
 
 
-@app.post("/leaderboard", response_class=JSONResponse)
-async def fetch_leaderboard(
-    request: Request, body: LeaderboardRequest, user_token: str = Depends(utils.user_authentication)
-):
-    lb = body.lb
-
+async def _get_leaderboard(lb, user_token):
+    """Return the leaderboard the user can see, or the message explaining why it is not available."""
     comp_org = COMPETITION_ID.split("/")[0]
     if user_token is not None:
-        is_user_admin = utils.is_user_admin(user_token, comp_org)
+        is_user_admin = await run_blocking(utils.is_user_admin, user_token, comp_org)
     else:
         is_user_admin = False
 
     if DISABLE_PUBLIC_LB == 1 and lb == "public" and not is_user_admin:
-        return {"response": "Public leaderboard is disabled by the competition host."}
+        return None, "Public leaderboard is disabled by the competition host."
 
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = await run_blocking(
+        get_competition_info, competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN
+    )
     leaderboard = Leaderboard(
         end_date=competition_info.end_date,
         eval_higher_is_better=competition_info.eval_higher_is_better,
@@ -205,8 +247,19 @@ async def fetch_leaderboard(
     if lb == "private":
         current_utc_time = datetime.datetime.now()
         if current_utc_time < competition_info.end_date and not is_user_admin:
-            return {"response": f"Private leaderboard will be available on {competition_info.end_date} UTC."}
-    df = leaderboard.fetch(private=lb == "private")
+            return None, f"Private leaderboard will be available on {competition_info.end_date} UTC."
+    return leaderboard, None
+
+
+@app.post("/leaderboard", response_class=JSONResponse)
+async def fetch_leaderboard(
+    request: Request, body: LeaderboardRequest, user_token: str = Depends(utils.user_authentication)
+):
+    lb = body.lb
+    leaderboard, message = await _get_leaderboard(lb, user_token)
+    if leaderboard is None:
+        return {"response": message}
+    df = await run_blocking(leaderboard.fetch, private=lb == "private")
 
     if len(df) == 0:
         return {"response": "No teams yet. Why not make a submission?"}
@@ -214,9 +267,39 @@ async def fetch_leaderboard(
     return resp
 
 
+@app.get("/leaderboard/rows", response_class=JSONResponse)
+async def fetch_leaderboard_rows(
+    request: Request,
+    lb: Literal["public", "private"] = "public",
+    offset: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=LEADERBOARD_PAGE_MAX),
+    around_my_team: bool = False,
+    user_token: str = Depends(utils.user_authentication),
+):
+    leaderboard, message = await _get_leaderboard(lb, user_token)
+    if leaderboard is None:
+        return {"response": message}
+
+    team_id = None
+    if around_my_team and user_token is not None:
+        team_id = await run_blocking(utils.get_team_id, user_token, COMPETITION_ID, HF_TOKEN)
+    page = await run_blocking(
+        leaderboard.fetch_page, private=lb == "private", offset=offset, limit=limit, team_id=team_id
+    )
+
+    # the page only changes with the ranking it is taken from and the request
+    etag = '"' + hashlib.sha256(repr((page["version"], lb, offset, limit, team_id)).encode()).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse({"response": page}, headers=headers)
+
+
 @app.post("/my_submissions", response_class=JSONResponse)
 async def my_submissions(request: Request, user_token: str = Depends(utils.user_authentication)):
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = await run_blocking(
+        get_competition_info, competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN
+    )
     if user_token is None:
         return {
             "response": {
@@ -235,7 +318,7 @@ async def my_submissions(request: Request, user_token: str = Depends(utils.user_
         hardware=competition_info.hardware,
     )
     try:
-        subs = sub.my_submissions(user_token)
+        subs = await run_blocking(sub.my_submissions, user_token)
     except AuthenticationError:
         return {
             "response": {
@@ -253,7 +336,7 @@ async def my_submissions(request: Request, user_token: str = Depends(utils.user_
     submission_text = SUBMISSION_TEXT.format(competition_info.submission_limit)
     submission_selection_text = SUBMISSION_SELECTION_TEXT.format(competition_info.selection_limit)
 
-    team_name = utils.get_team_name(user_token, COMPETITION_ID, HF_TOKEN)
+    team_name = await run_blocking(utils.get_team_name, user_token, COMPETITION_ID, HF_TOKEN)
 
     resp = {
         "response": {
@@ -284,10 +367,12 @@ async def new_submission(
     start_date = datetime.datetime.strptime(START_DATE, "%Y-%m-%d")
     if todays_date < start_date:
         comp_org = COMPETITION_ID.split("/")[0]
-        if not utils.is_user_admin(user_token, comp_org):
+        if not await run_blocking(utils.is_user_admin, user_token, comp_org):
             return {"response": "Competition has not started yet!"}
 
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = await run_blocking(
+        get_competition_info, competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN
+    )
     sub = Submissions(
         end_date=competition_info.end_date,
         submission_limit=competition_info.submission_limit,
@@ -295,13 +380,17 @@ async def new_submission(
         token=HF_TOKEN,
         competition_type=competition_info.competition_type,
         hardware=competition_info.hardware,
+        submission_cols=competition_info.submission_cols,
+        submission_rows=competition_info.submission_rows,
+        submission_id_col=competition_info.submission_id_col,
+        metric=competition_info.metric,
     )
     try:
         if competition_info.competition_type == "generic":
-            resp = sub.new_submission(user_token, submission_file, submission_comment)
+            resp = await run_blocking(sub.new_submission, user_token, submission_file, submission_comment)
             return {"response": f"Success! You have {resp} submissions remaining today."}
         if competition_info.competition_type == "script":
-            resp = sub.new_submission(user_token, hub_model, submission_comment)
+            resp = await run_blocking(sub.new_submission, user_token, hub_model, submission_comment)
             return {"response": f"Success! You have {resp} submissions remaining today."}
     except RequestException:
         return {"response": "Hugging Face Hub is unreachable, please try again later"}
@@ -309,8 +398,10 @@ async def new_submission(
         return {"response": "Invalid token"}
     except PastDeadlineError:
         return {"response": "Competition has ended"}
-    except SubmissionError:
-        return {"response": "Invalid submission file"}
+    except SubmissionValidationError as e:
+        return {"response": str(e), "details": e.to_dict()}
+    except SubmissionError as e:
+        return {"response": str(e)}
     except SubmissionLimitError:
         return {"response": "Submission limit reached"}
     return {"response": "Invalid competition type"}
@@ -325,7 +416,7 @@ def update_selected_submissions(
     if user_token is None:
         return {"success": False, "error": "Invalid token, please login."}
 
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = get_competition_info(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
     sub = Submissions(
         end_date=competition_info.end_date,
         submission_limit=competition_info.submission_limit,
@@ -367,11 +458,13 @@ def update_team_name(
 @app.post("/admin/comp_info", response_class=JSONResponse)
 async def admin_comp_info(request: Request, user_token: str = Depends(utils.user_authentication)):
     comp_org = COMPETITION_ID.split("/")[0]
-    user_is_admin = utils.is_user_admin(user_token, comp_org)
+    user_is_admin = await run_blocking(utils.is_user_admin, user_token, comp_org)
     if not user_is_admin:
         return {"response": "You are not an admin."}, 403
 
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = await run_blocking(
+        get_competition_info, competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN
+    )
 
     markdowns = {
         "competition_desc": competition_info.competition_desc,
@@ -406,11 +499,13 @@ async def admin_comp_info(request: Request, user_token: str = Depends(utils.user
 @app.post("/admin/update_comp_info", response_class=JSONResponse)
 async def update_comp_info(request: Request, user_token: str = Depends(utils.user_authentication)):
     comp_org = COMPETITION_ID.split("/")[0]
-    user_is_admin = utils.is_user_admin(user_token, comp_org)
+    user_is_admin = await run_blocking(utils.is_user_admin, user_token, comp_org)
     if not user_is_admin:
         return {"response": "You are not an admin."}, 403
 
-    competition_info = CompetitionInfo(competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN)
+    competition_info = await run_blocking(
+        get_competition_info, competition_id=COMPETITION_ID, autotrain_token=HF_TOKEN
+    )
 
     data = await request.json()
     config = data["config"]
@@ -439,9 +534,15 @@ async def update_comp_info(request: Request, user_token: str = Depends(utils.use
             return {"success": False, "error": f"Invalid key: {key}"}
 
     try:
-        competition_info.update_competition_info(config, markdowns, HF_TOKEN)
+        await run_blocking(competition_info.update_competition_info, config, markdowns, HF_TOKEN)
     except Exception as e:
         logger.error(e)
         return {"success": False}, 500
 
     return {"success": True}
+
+
+@app.get("/metrics")
+def metrics():
+    # prometheus metrics of the app, its job runner and their evaluation processes
+    return Response(instrumentation.render(), media_type=instrumentation.CONTENT_TYPE)
@@ -2,60 +2,53 @@ import importlib
 import os
 import sys
 
-import pandas as pd
-from huggingface_hub import hf_hub_download
 from sklearn import metrics
 
+from competitions import hub
+from competitions.formats import SUBMISSION_FORMATS, iter_submission, read_submission, submission_format
+from competitions.instrumentation import EVALUATION_STAGE_SECONDS
+from competitions.solution import load_solution
+from competitions.streaming import STREAMING_CHUNK_SIZE, score_streaming, supports_streaming
+
+
+def _submission_path_in_repo(params):
+    # the submission is stored with the extension it was uploaded with
+    candidates = [f"submissions/{params.team_id}-{params.submission_id}.{ext}" for ext in SUBMISSION_FORMATS]
+    found = hub.paths_info(params.competition_id, candidates, params.token)
+    if not found:
+        raise FileNotFoundError(f"No submission file found for submission {params.submission_id}")
+    return next(path for path in candidates if path in found)
+
 
 def compute_metrics(params):
     if params.metric == "custom":
-        metric_file = hf_hub_download(
-            repo_id=params.competition_id,
-            filename="metric.py",
-            token=params.token,
-            repo_type="dataset",
-        )
+        with EVALUATION_STAGE_SECONDS.timer(stage="download"):
+            metric_file = hub.download(params.competition_id, "metric.py", params.token)
         sys.path.append(os.path.dirname(metric_file))
         metric = importlib.import_module("metric")
-        evaluation = metric.compute(params)
+        with EVALUATION_STAGE_SECONDS.timer(stage="scoring"):
+            evaluation = metric.compute(params)
     else:
-        solution_file = hf_hub_download(
-            repo_id=params.competition_id,
-            filename="solution.csv",
-            token=params.token,
-            repo_type="dataset",
-        )
-
-        solution_df = pd.read_csv(solution_file)
-
-        submission_filename = f"submissions/{params.team_id}-{params.submission_id}.csv"
-        submission_file = hf_hub_download(
-            repo_id=params.competition_id,
-            filename=submission_filename,
-            token=params.token,
-            repo_type="dataset",
-        )
-        submission_df = pd.read_csv(submission_file)
-
-        public_ids = solution_df[solution_df.split == "public"][params.submission_id_col].values
-        private_ids = solution_df[solution_df.split == "private"][params.submission_id_col].values
-
-        public_solution_df = solution_df[solution_df[params.submission_id_col].isin(public_ids)]
-        public_submission_df = submission_df[submission_df[params.submission_id_col].isin(public_ids)]
-
-        private_solution_df = solution_df[solution_df[params.submission_id_col].isin(private_ids)]
-        private_submission_df = submission_df[submission_df[params.submission_id_col].isin(private_ids)]
+        with EVALUATION_STAGE_SECONDS.timer(stage="download"):
+            solution = load_solution(params)
 
-        public_solution_df = public_solution_df.sort_values(params.submission_id_col).reset_index(drop=True)
-        public_submission_df = public_submission_df.sort_values(params.submission_id_col).reset_index(drop=True)
+            submission_filename = _submission_path_in_repo(params)
+            submission_file = hub.download(params.competition_id, submission_filename, params.token)
+        fmt = submission_format(submission_filename)
 
-        private_solution_df = private_solution_df.sort_values(params.submission_id_col).reset_index(drop=True)
-        private_submission_df = private_submission_df.sort_values(params.submission_id_col).reset_index(drop=True)
+        with EVALUATION_STAGE_SECONDS.timer(stage="scoring"):
+            if supports_streaming(params, solution):
+                # large submissions are scored chunk by chunk instead of being loaded at once
+                usecols = [solution.id_col] + solution.target_cols
+                chunks = iter_submission(submission_file, fmt, usecols, STREAMING_CHUNK_SIZE)
+                public_score, private_score = score_streaming(chunks, solution, params.metric)
+            else:
+                submission_df = read_submission(submission_file, fmt)
+                public_predictions, private_predictions = solution.align(submission_df)
 
-        _metric = getattr(metrics, params.metric)
-        target_cols = [col for col in solution_df.columns if col not in [params.submission_id_col, "split"]]
-        public_score = _metric(public_solution_df[target_cols], public_submission_df[target_cols])
-        private_score = _metric(private_solution_df[target_cols], private_submission_df[target_cols])
+                _metric = getattr(metrics, params.metric)
+                public_score = _metric(solution.public_targets, public_predictions)
+                private_score = _metric(solution.private_targets, private_predictions)
 
         # scores can also be dictionaries for multiple metrics
         evaluation = {
@@ -2,6 +2,10 @@ class AuthenticationError(Exception):
     pass
 
 
+class InvalidTokenError(Exception):
+    pass
+
+
 class NoSubmissionError(Exception):
     pass
 
@@ -10,6 +14,40 @@ class SubmissionError(Exception):
     pass
 
 
+class SubmissionValidationError(SubmissionError):
+    """
+    Ids of a submission that do not match the solution.
+
+    `extra_ids` can be the first of `num_extra_ids` extra ids, their number is not bounded by the solution.
+    """
+
+    def __init__(self, missing_ids=None, duplicate_ids=None, extra_ids=None, num_extra_ids=None):
+        self.missing_ids = list(missing_ids) if missing_ids is not None else []
+        self.duplicate_ids = list(duplicate_ids) if duplicate_ids is not None else []
+        self.extra_ids = list(extra_ids) if extra_ids is not None else []
+        self.num_extra_ids = num_extra_ids if num_extra_ids is not None else len(self.extra_ids)
+        problems = []
+        for name, ids, num_ids in (
+            ("missing", self.missing_ids, len(self.missing_ids)),
+            ("duplicate", self.duplicate_ids, len(self.duplicate_ids)),
+            ("extra", self.extra_ids, self.num_extra_ids),
+        ):
+            if num_ids:
+                problems.append(f"{num_ids} {name} ids (e.g. {', '.join(str(i) for i in ids[:5])})")
+        super().__init__("Invalid submission: " + "; ".join(problems))
+
+    def to_dict(self, max_ids=100):
+        """Number of ids of every kind and the first `max_ids` of them, e.g. for an api response."""
+        return {
+            "num_missing_ids": len(self.missing_ids),
+            "missing_ids": self.missing_ids[:max_ids],
+            "num_duplicate_ids": len(self.duplicate_ids),
+            "duplicate_ids": self.duplicate_ids[:max_ids],
+            "num_extra_ids": self.num_extra_ids,
+            "extra_ids": self.extra_ids[:max_ids],
+        }
+
+
 class SubmissionLimitError(Exception):
     pass
 
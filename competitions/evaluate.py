@@ -5,13 +5,13 @@ import shlex
 import shutil
 import subprocess
 
-from huggingface_hub import HfApi, hf_hub_download, snapshot_download
 from huggingface_hub.utils._errors import EntryNotFoundError
 from loguru import logger
 
-from competitions import utils
+from competitions import hub, utils
 from competitions.compute_metrics import compute_metrics
 from competitions.enums import SubmissionStatus
+from competitions.instrumentation import EVALUATION_STAGE_SECONDS
 from competitions.params import EvalParams
 
 
@@ -28,12 +28,13 @@ def upload_submission_file(params, file_path):
 
 def generate_submission_file(params):
     logger.info("Downloading submission dataset")
-    submission_dir = snapshot_download(
-        repo_id=params.submission_repo,
-        local_dir=params.output_path,
-        token=os.environ.get("USER_TOKEN"),
-        repo_type="model",
-    )
+    with EVALUATION_STAGE_SECONDS.timer(stage="download"):
+        submission_dir = hub.snapshot(
+            params.submission_repo,
+            os.environ.get("USER_TOKEN"),
+            local_dir=params.output_path,
+            repo_type="model",
+        )
     # submission_dir has a script.py file
     # start a subprocess to run the script.py
     # the script.py will generate a submission.csv file in the submission_dir
@@ -60,12 +61,13 @@ def generate_submission_file(params):
     process = subprocess.Popen(cmd, cwd=submission_dir, env=env)
 
     # Wait for the process to complete or timeout
-    try:
-        process.wait(timeout=params.time_limit)
-    except subprocess.TimeoutExpired:
-        logger.info(f"Process exceeded {params.time_limit} seconds time limit. Terminating...")
-        process.kill()
-        process.wait()
+    with EVALUATION_STAGE_SECONDS.timer(stage="script"):
+        try:
+            process.wait(timeout=params.time_limit)
+        except subprocess.TimeoutExpired:
+            logger.info(f"Process exceeded {params.time_limit} seconds time limit. Terminating...")
+            process.kill()
+            process.wait()
 
     # Check if process terminated due to timeout
     if process.returncode and process.returncode != 0:
@@ -76,16 +78,16 @@ def generate_submission_file(params):
     logger.info("contents of submission_dir")
     logger.info(os.listdir(submission_dir))
 
-    api = HfApi(token=params.token)
     for sub_file in params.submission_filenames:
         logger.info(f"Uploading {sub_file} to the repository")
         sub_file_ext = sub_file.split(".")[-1]
-        api.upload_file(
-            path_or_fileobj=f"{submission_dir}/{sub_file}",
-            path_in_repo=f"submissions/{params.team_id}-{params.submission_id}.{sub_file_ext}",
-            repo_id=params.competition_id,
-            repo_type="dataset",
-        )
+        with EVALUATION_STAGE_SECONDS.timer(stage="upload"):
+            hub.upload(
+                params.competition_id,
+                f"submissions/{params.team_id}-{params.submission_id}.{sub_file_ext}",
+                f"{submission_dir}/{sub_file}",
+                params.token,
+            )
 
 
 @utils.monitor
@@ -98,38 +100,33 @@ def run(params):
 
     if params.competition_type == "script":
         try:
-            requirements_fname = hf_hub_download(
-                repo_id=params.competition_id,
-                filename="requirements.txt",
-                token=params.token,
-                repo_type="dataset",
-            )
+            requirements_fname = hub.download(params.competition_id, "requirements.txt", params.token)
         except EntryNotFoundError:
             requirements_fname = None
 
         if requirements_fname:
             logger.info("Installing requirements")
-            utils.uninstall_requirements(requirements_fname)
-            utils.install_requirements(requirements_fname)
+            with EVALUATION_STAGE_SECONDS.timer(stage="requirements"):
+                utils.uninstall_requirements(requirements_fname)
+                utils.install_requirements(requirements_fname)
         if len(str(params.dataset).strip()) > 0:
             # _ = Repository(local_dir="/tmp/data", clone_from=params.dataset, token=params.token)
-            _ = snapshot_download(
-                repo_id=params.dataset,
-                local_dir="/tmp/data",
-                token=params.token,
-                repo_type="dataset",
-            )
+            with EVALUATION_STAGE_SECONDS.timer(stage="download"):
+                _ = hub.snapshot(params.dataset, params.token, local_dir="/tmp/data")
         generate_submission_file(params)
 
     evaluation = compute_metrics(params)
 
-    utils.update_submission_score(params, evaluation["public_score"], evaluation["private_score"])
-    utils.update_submission_status(params, SubmissionStatus.SUCCESS.value)
-    utils.delete_space(params)
+    with EVALUATION_STAGE_SECONDS.timer(stage="upload"):
+        utils.update_submission_score(params, evaluation["public_score"], evaluation["private_score"])
+        utils.update_submission_status(params, SubmissionStatus.SUCCESS.value)
+    return True
 
 
 if __name__ == "__main__":
     args = parse_args()
     _params = json.load(open(args.config, encoding="utf-8"))
     _params = EvalParams(**_params)
-    run(_params)
+    # outside of `run`, a failure to commit the result must not mark the evaluated submission as failed
+    if run(_params):
+        utils.delete_space(_params)
@@ -0,0 +1,73 @@
+import io
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+
+from competitions.errors import SubmissionError
+
+
+# file extension of a submission -> format it is read as
+SUBMISSION_FORMATS = {
+    "csv": "csv",
+    "parquet": "parquet",
+    "arrow": "arrow",
+    "feather": "arrow",
+    "ipc": "arrow",
+}
+
+
+def submission_format(filename):
+    """Return the format of a submission file from its name, None if it is not a tabular format."""
+    return SUBMISSION_FORMATS.get(filename.rsplit(".", 1)[-1].lower())
+
+
+def _open_ipc(source):
+    try:
+        return pa.ipc.open_file(source)
+    except pa.ArrowInvalid:
+        source.seek(0)
+        return pa.ipc.open_stream(source)
+
+
+def read_columns(data, fmt):
+    """Read the column names of a submission from its bytes, only the header or schema is parsed."""
+    try:
+        if fmt == "csv":
+            return pd.read_csv(io.BytesIO(data), nrows=0).columns.tolist()
+        if fmt == "parquet":
+            return pq.read_schema(pa.BufferReader(data)).names
+        return _open_ipc(pa.BufferReader(data)).schema.names
+    except (ValueError, pa.ArrowException) as e:
+        raise SubmissionError(f"Could not read {fmt} submission: {e}") from e
+
+
+def _read_ipc_table(source, columns=None):
+    # files are memory mapped, record batches reference the mapped pages instead of being copied
+    if isinstance(source, str):
+        source = pa.memory_map(source, "r")
+    table = _open_ipc(source).read_all()
+    return table.select(columns) if columns is not None else table
+
+
+def read_submission(path, fmt, columns=None):
+    if fmt == "csv":
+        return pd.read_csv(path, usecols=columns)
+    if fmt == "parquet":
+        return pq.read_table(path, columns=columns, memory_map=True).to_pandas()
+    return _read_ipc_table(path, columns).to_pandas()
+
+
+def iter_submission(path, fmt, columns, chunksize):
+    """Yield a submission, from a path or a file object, as dataframes of at most `chunksize` rows."""
+    if fmt == "csv":
+        with pd.read_csv(path, usecols=columns, chunksize=chunksize) as chunks:
+            yield from chunks
+        return
+    if fmt == "parquet":
+        batches = pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=chunksize, columns=columns)
+    else:
+        batches = _read_ipc_table(path, columns).to_batches(max_chunksize=chunksize)
+    for batch in batches:
+        yield batch.to_pandas()
@@ -0,0 +1,74 @@
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import brotli
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+
+HTTP_CACHE_SIZE = 64
+
+_ENCODERS = {
+    "br": lambda body: brotli.compress(body, quality=11),
+    "gzip": lambda body: gzip.compress(body, compresslevel=9),
+}
+
+# (etag, encoding) -> encoded body, the bodies of a revision are compressed once
+_BODIES = OrderedDict()
+_BODIES_LOCK = threading.Lock()
+
+
+def _accepted_encoding(request):
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip().lower())
+    for encoding in ("br", "gzip"):
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return "identity"
+
+
+def _encoded_body(etag, encoding, content):
+    key = (etag, encoding)
+    with _BODIES_LOCK:
+        if key in _BODIES:
+            _BODIES.move_to_end(key)
+            return _BODIES[key]
+
+    body = json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if encoding != "identity":
+        body = _ENCODERS[encoding](body)
+    with _BODIES_LOCK:
+        _BODIES[key] = body
+        while len(_BODIES) > HTTP_CACHE_SIZE:
+            _BODIES.popitem(last=False)
+    return body
+
+
+def cached_json_response(request: Request, content, revision, key):
+    """
+    JSON response for `content` that only changes with `revision`, e.g. the markdown files of a competition.
+
+    The response has a strong ETag derived from the revision, the `key` of the content and the encoding. A request
+    with a matching If-None-Match gets a 304 without body, otherwise the body is sent compressed with brotli or gzip
+    if the client accepts it. Without a revision, a plain uncached response is returned.
+    """
+    if revision is None:
+        return JSONResponse(content)
+
+    encoding = _accepted_encoding(request)
+    digest = hashlib.sha256(f"{revision}:{key}".encode()).hexdigest()[:32]
+    etag = f'"{digest}-{encoding}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(_encoded_body(etag, encoding, content), media_type="application/json", headers=headers)
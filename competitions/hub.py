@@ -0,0 +1,476 @@
+import asyncio
+import atexit
+import functools
+import io
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from huggingface_hub import (
+    CommitOperationAdd,
+    HfApi,
+    configure_http_backend,
+    constants,
+    get_session,
+    hf_hub_download,
+    snapshot_download,
+)
+from huggingface_hub.hf_api import RepoFile
+from huggingface_hub.utils import HfHubHTTPError
+from huggingface_hub.utils._errors import EntryNotFoundError
+from huggingface_hub.utils._http import OfflineAdapter, UniqueRequestIdAdapter
+from loguru import logger
+from urllib3 import PoolManager
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from competitions import local_hub
+from competitions.instrumentation import HUB_REQUEST_SECONDS, register_callback
+
+
+HUB_MAX_WORKERS = int(os.environ.get("HUB_MAX_WORKERS", 16))
+HUB_POOL_SIZE = int(os.environ.get("HUB_POOL_SIZE", 32))
+# seconds staged json files wait before they are committed, 0 commits every write right away
+HUB_COMMIT_INTERVAL = float(os.environ.get("HUB_COMMIT_INTERVAL", 2))
+HUB_COMMIT_MAX_OPERATIONS = int(os.environ.get("HUB_COMMIT_MAX_OPERATIONS", 100))
+HUB_COMMIT_RETRIES = int(os.environ.get("HUB_COMMIT_RETRIES", 5))
+HUB_COMMIT_BACKOFF = float(os.environ.get("HUB_COMMIT_BACKOFF", 0.5))
+# serve every repo from this directory instead of the hub, see `local_hub`, e.g. to load test without network
+HUB_LOCAL_DIR = os.environ.get("HUB_LOCAL_DIR")
+SERVER_TOKEN = os.environ.get("HF_TOKEN")
+
+_POOL_STATS = {"requests": 0, "opened": 0}
+_POOL_STATS_LOCK = threading.Lock()
+
+
+def _count(stat):
+    with _POOL_STATS_LOCK:
+        _POOL_STATS[stat] += 1
+
+
+class _CountingConnectionMixin:
+    def connect(self):
+        _count("opened")
+        super().connect()
+
+
+class _CountingHTTPConnection(_CountingConnectionMixin, HTTPConnection):
+    pass
+
+
+class _CountingHTTPSConnection(_CountingConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _CountingPoolManager(PoolManager):
+    # every request takes a connection from the pool of its host, a connection is only opened when none is idle
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_classes_by_scheme = {"http": _CountingHTTPConnectionPool, "https": _CountingHTTPSConnectionPool}
+
+    def connection_from_host(self, *args, **kwargs):
+        _count("requests")
+        return super().connection_from_host(*args, **kwargs)
+
+
+class _PooledAdapter(UniqueRequestIdAdapter):
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager = _CountingPoolManager(num_pools=connections, maxsize=maxsize, block=block, **pool_kwargs)
+
+
+# a single adapter, and therefore a single keep-alive pool per host, shared by the sessions huggingface_hub
+# creates for each thread
+_ADAPTER = _PooledAdapter(pool_connections=4, pool_maxsize=HUB_POOL_SIZE)
+
+
+def _backend_factory():
+    session = requests.Session()
+    adapter = OfflineAdapter() if constants.HF_HUB_OFFLINE else _ADAPTER
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+configure_http_backend(backend_factory=_backend_factory)
+
+
+def pool_stats():
+    with _POOL_STATS_LOCK:
+        return {"hits": _POOL_STATS["requests"] - _POOL_STATS["opened"], "misses": _POOL_STATS["opened"]}
+
+
+register_callback(
+    "competitions_hub_pool_connections_total",
+    "Connections taken from the hub connection pool, reused from the pool or newly opened.",
+    "counter",
+    lambda: {("reused",): pool_stats()["hits"], ("opened",): pool_stats()["misses"]},
+    labelnames=["result"],
+)
+
+
+def http_get(url, **kwargs):
+    """GET request to the hub outside of huggingface_hub, reusing the shared connection pool."""
+    if HUB_LOCAL_DIR:
+        return local_hub.whoami_response(url, **kwargs)
+    return get_session().get(url, **kwargs)
+
+
+# blocking hub calls made from async handlers are offloaded to this pool, its size bounds the number of
+# concurrent hub requests made by the app
+_HUB_EXECUTOR = ThreadPoolExecutor(max_workers=HUB_MAX_WORKERS, thread_name_prefix="hub")
+# downloads of the files of a commit, apart from the pool above whose threads make the commits
+_DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=HUB_MAX_WORKERS, thread_name_prefix="hub-download")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking function in the hub executor without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_HUB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+@functools.lru_cache(maxsize=1)
+def _server_api():
+    return HfApi(token=SERVER_TOKEN)
+
+
+def get_api(token):
+    # only the api of the server token is kept, user tokens must not outlive the request they came with
+    if token is not None and token == SERVER_TOKEN:
+        return _server_api()
+    return HfApi(token=token)
+
+
+def _local_repo(repo_id, repo_type="dataset"):
+    return local_hub.get_repo(HUB_LOCAL_DIR, repo_id, repo_type)
+
+
+def download(repo_id, filename, token, revision=None, repo_type="dataset"):
+    with HUB_REQUEST_SECONDS.timer(operation="download"):
+        if HUB_LOCAL_DIR:
+            return _local_repo(repo_id, repo_type).download(filename, revision=revision)
+        return hf_hub_download(
+            repo_id=repo_id,
+            filename=filename,
+            revision=revision,
+            token=token,
+            repo_type=repo_type,
+        )
+
+
+def download_json(repo_id, filename, token, revision=None):
+    if revision is None:
+        # files staged by this process and not committed yet are read from the commit batcher
+        staged = _COMMIT_BATCHER.read(repo_id, filename)
+        if staged is not None:
+            return staged
+    fname = download(repo_id, filename, token, revision=revision)
+    with open(fname, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def snapshot(repo_id, token, allow_patterns=None, revision=None, local_dir=None, repo_type="dataset"):
+    with HUB_REQUEST_SECONDS.timer(operation="snapshot"):
+        if HUB_LOCAL_DIR:
+            return _local_repo(repo_id, repo_type).snapshot(allow_patterns, revision=revision, local_dir=local_dir)
+        return snapshot_download(
+            repo_id=repo_id,
+            allow_patterns=allow_patterns,
+            revision=revision,
+            local_dir=local_dir,
+            token=token,
+            repo_type=repo_type,
+        )
+
+
+def upload(repo_id, path_in_repo, path_or_fileobj, token, repo_type="dataset"):
+    with HUB_REQUEST_SECONDS.timer(operation="upload"):
+        if HUB_LOCAL_DIR:
+            operation = CommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=path_or_fileobj)
+            _local_repo(repo_id, repo_type).commit([operation], f"Upload {path_in_repo}")
+            return
+        get_api(token).upload_file(
+            path_or_fileobj=path_or_fileobj,
+            path_in_repo=path_in_repo,
+            repo_id=repo_id,
+            repo_type=repo_type,
+        )
+
+
+def upload_json(repo_id, path_in_repo, data, token):
+    data_json = json.dumps(data, indent=4)
+    data_json_bytes = data_json.encode("utf-8")
+    upload(repo_id, path_in_repo, io.BytesIO(data_json_bytes), token)
+
+
+def _download_json_or_none(repo_id, filename, token, revision):
+    try:
+        return download_json(repo_id, filename, token, revision=revision)
+    except EntryNotFoundError:
+        return None
+
+
+def _is_commit_conflict(e):
+    return e.response is not None and e.response.status_code in (409, 412)
+
+
+def _create_commit(repo_id, operations, commit_message, token, parent_commit=None):
+    with HUB_REQUEST_SECONDS.timer(operation="commit"):
+        if HUB_LOCAL_DIR:
+            return _local_repo(repo_id).commit(operations, commit_message, parent_commit=parent_commit)
+        return get_api(token).create_commit(
+            repo_id=repo_id,
+            repo_type="dataset",
+            operations=operations,
+            commit_message=commit_message,
+            parent_commit=parent_commit,
+        )
+
+
+def commit_json_updates(repo_id, updates, token, files=None):
+    """
+    Apply mutations to json files of a repo and commit the results, with optimistic concurrency.
+
+    `updates` maps the path of every file to the list of mutations to apply to it, in order. A mutation gets the
+    current content of the file, None if it does not exist yet, and returns the new content. The files are read at
+    the head commit of the repo and committed with that commit as parent, if anything was committed in between the
+    commit is rejected and the mutations are applied again to the new content, after an exponential backoff.
+    `files` maps the path of other files to add in the same commit to their content.
+
+    Returns the committed content of every json file.
+    """
+    files = files or {}
+    for attempt in range(HUB_COMMIT_RETRIES + 1):
+        sha = repo_sha(repo_id, token)
+        # the files are downloaded concurrently, the sooner the commit is made the less likely it is to conflict
+        contents = dict(
+            zip(
+                updates,
+                _DOWNLOAD_EXECUTOR.map(
+                    lambda path_in_repo: _download_json_or_none(repo_id, path_in_repo, token, revision=sha), updates
+                ),
+            )
+        )
+        results = {}
+        for path_in_repo, mutations in updates.items():
+            data = contents[path_in_repo]
+            for mutation in mutations:
+                data = mutation(data)
+            results[path_in_repo] = data
+
+        operations = [
+            CommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=json.dumps(data, indent=4).encode("utf-8"))
+            for path_in_repo, data in results.items()
+        ]
+        operations.extend(
+            CommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=content)
+            for path_in_repo, content in files.items()
+        )
+        try:
+            _create_commit(repo_id, operations, f"Update {len(operations)} files", token, parent_commit=sha)
+            return results
+        except HfHubHTTPError as e:
+            if not _is_commit_conflict(e) or attempt == HUB_COMMIT_RETRIES:
+                raise
+            delay = random.uniform(0, HUB_COMMIT_BACKOFF * 2**attempt)
+            logger.info(f"{repo_id} changed since {sha}, retrying commit in {delay:.2f} seconds")
+            time.sleep(delay)
+
+
+class CommitBatcher:
+    """
+    Write-behind buffer of json file updates that are committed to the hub together.
+
+    Mutations of staged files are committed by a background thread every `interval` seconds, or as soon as
+    `max_operations` files are waiting, with a single `commit_json_updates` per repo. Until their commit lands, `read`
+    returns the content with every staged mutation applied so that the process reads its own writes. Other files,
+    e.g. submissions, can be staged with `stage_file` to be added by the same commits.
+    """
+
+    def __init__(self, interval, max_operations):
+        self.interval = interval
+        self.max_operations = max_operations
+        # (repo_id, path_in_repo) -> staged file
+        self._staged = {}
+        # (repo_id, path_in_repo) -> staged file that is not a json update
+        self._staged_files = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def stage(self, repo_id, path_in_repo, mutation, token):
+        key = (repo_id, path_in_repo)
+        while True:
+            with self._lock:
+                staged = self._staged.get(key)
+                content = staged["content"] if staged is not None else None
+            if staged is None:
+                data = _download_json_or_none(repo_id, path_in_repo, token, revision=None)
+            else:
+                data = json.loads(content)
+
+            with self._lock:
+                # a concurrent stage or flush of the same file changed it since it was read here, read it again
+                if self._staged.get(key) is not staged or (staged is not None and staged["content"] is not content):
+                    continue
+                data = mutation(data)
+                if staged is None:
+                    staged = self._staged[key] = {"mutations": [], "token": token}
+                staged["mutations"].append(mutation)
+                staged["content"] = json.dumps(data, indent=4).encode("utf-8")
+                self._staged_changed()
+            return data
+
+    def stage_file(self, repo_id, path_in_repo, content, token):
+        with self._lock:
+            self._staged_files[(repo_id, path_in_repo)] = {"content": content, "token": token}
+            self._staged_changed()
+
+    def _staged_changed(self):
+        # called with the lock held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="hub-commits", daemon=True)
+            self._thread.start()
+        if len(self._staged) + len(self._staged_files) >= self.max_operations:
+            self._wake.set()
+
+    def read(self, repo_id, path_in_repo):
+        with self._lock:
+            staged = self._staged.get((repo_id, path_in_repo))
+            content = staged["content"] if staged is not None else None
+        if content is None:
+            return None
+        return json.loads(content)
+
+    def flush(self, raise_errors=False):
+        """Commit the staged mutations, the ones that failed stay staged and the first error is raised if asked."""
+        error = None
+        with self._flush_lock:
+            commits = {}
+            with self._lock:
+                for (repo_id, path_in_repo), staged in self._staged.items():
+                    updates, _ = commits.setdefault((repo_id, staged["token"]), ({}, {}))
+                    updates[path_in_repo] = list(staged["mutations"])
+                for (repo_id, path_in_repo), staged in self._staged_files.items():
+                    _, files = commits.setdefault((repo_id, staged["token"]), ({}, {}))
+                    files[path_in_repo] = staged
+
+            for (repo_id, token), (updates, files) in commits.items():
+                try:
+                    commit_json_updates(
+                        repo_id, updates, token, files={path: staged["content"] for path, staged in files.items()}
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to commit {len(updates) + len(files)} files to {repo_id}: {e}")
+                    error = error or e
+                    continue
+                with self._lock:
+                    for path_in_repo, staged in files.items():
+                        # unless staged again while committing
+                        if self._staged_files.get((repo_id, path_in_repo)) is staged:
+                            del self._staged_files[(repo_id, path_in_repo)]
+                    # mutations staged while committing stay for the next flush
+                    for path_in_repo, mutations in updates.items():
+                        staged = self._staged[(repo_id, path_in_repo)]
+                        del staged["mutations"][: len(mutations)]
+                        if not staged["mutations"]:
+                            del self._staged[(repo_id, path_in_repo)]
+        if error is not None and raise_errors:
+            raise error
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+
+_COMMIT_BATCHER = CommitBatcher(HUB_COMMIT_INTERVAL, HUB_COMMIT_MAX_OPERATIONS)
+
+
+def update_json(repo_id, path_in_repo, mutation, token):
+    """
+    Update a json file with `mutation`, see `commit_json_updates`, and return its new content.
+
+    The update goes through the commit batcher, or is committed right away if batching is disabled. Either way the
+    mutation is applied again on top of any concurrent change, so it must only depend on the content it is given.
+    """
+    if HUB_COMMIT_INTERVAL <= 0:
+        return commit_json_updates(repo_id, {path_in_repo: [mutation]}, token)[path_in_repo]
+    return _COMMIT_BATCHER.stage(repo_id, path_in_repo, mutation, token)
+
+
+def upload_batched(repo_id, path_in_repo, content, token):
+    """Add a file with the next commit of the staged json updates, or right away if batching is disabled."""
+    if HUB_COMMIT_INTERVAL <= 0:
+        upload(repo_id, path_in_repo, content, token)
+        return
+    _COMMIT_BATCHER.stage_file(repo_id, path_in_repo, content, token)
+
+
+def flush_commits():
+    """
+    Commit every staged json update now, e.g. before the process exits.
+
+    Failed commits are retried with an exponential backoff, the error is raised if the updates could still not be
+    committed after `HUB_COMMIT_RETRIES` retries. The updates stay staged in that case.
+    """
+    for attempt in range(HUB_COMMIT_RETRIES + 1):
+        try:
+            _COMMIT_BATCHER.flush(raise_errors=True)
+            return
+        except Exception:
+            if attempt == HUB_COMMIT_RETRIES:
+                raise
+            delay = random.uniform(0, HUB_COMMIT_BACKOFF * 2**attempt)
+            logger.warning(f"Failed to commit staged updates, retrying in {delay:.2f} seconds")
+            time.sleep(delay)
+
+
+atexit.register(flush_commits)
+
+
+def repo_sha(repo_id, token):
+    with HUB_REQUEST_SECONDS.timer(operation="repo_info"):
+        if HUB_LOCAL_DIR:
+            return _local_repo(repo_id).head()
+        return get_api(token).dataset_info(repo_id=repo_id).sha
+
+
+def list_blobs(repo_id, path_in_repo, token, revision=None):
+    """Return the blob id of every file under `path_in_repo`, or an empty dict if the folder does not exist."""
+    with HUB_REQUEST_SECONDS.timer(operation="list_tree"):
+        if HUB_LOCAL_DIR:
+            return _local_repo(repo_id).list_blobs(path_in_repo, revision=revision)
+        try:
+            repo_files = get_api(token).list_repo_tree(
+                repo_id=repo_id,
+                path_in_repo=path_in_repo,
+                repo_type="dataset",
+                revision=revision,
+            )
+            return {f.path: f.blob_id for f in repo_files if isinstance(f, RepoFile)}
+        except EntryNotFoundError:
+            return {}
+
+
+def paths_info(repo_id, paths, token):
+    """Return the blob id of each of `paths` that exists in the repo."""
+    with HUB_REQUEST_SECONDS.timer(operation="paths_info"):
+        if HUB_LOCAL_DIR:
+            return _local_repo(repo_id).paths_info(paths)
+        repo_files = get_api(token).get_paths_info(repo_id=repo_id, paths=paths, repo_type="dataset")
+    return {f.path: f.blob_id for f in repo_files if isinstance(f, RepoFile)}
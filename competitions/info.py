@@ -1,59 +1,47 @@
+import hashlib
 import io
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
+from typing import Dict, List, Optional
 
-from huggingface_hub import HfApi, hf_hub_download
+from huggingface_hub.utils._errors import EntryNotFoundError
+from loguru import logger
+
+from competitions import hub
+
+
+COMPETITION_INFO_TTL = float(os.environ.get("COMPETITION_INFO_TTL", 60))
+COMPETITION_INFO_FILES = ["conf.json", "COMPETITION_DESC.md", "DATASET_DESC.md", "SUBMISSION_DESC.md", "RULES.md"]
 
 
 @dataclass
 class CompetitionInfo:
     competition_id: str
     autotrain_token: str
+    # hash of the competition files, set when loaded through get_competition_info
+    revision: Optional[str] = None
+    # files known to exist in the competition repo, optional files missing from it are not requested
+    available_files: Optional[List[str]] = None
 
     def __post_init__(self):
-        config_fname = hf_hub_download(
-            repo_id=self.competition_id,
-            filename="conf.json",
-            use_auth_token=self.autotrain_token,
-            repo_type="dataset",
-        )
-        competition_desc = hf_hub_download(
-            repo_id=self.competition_id,
-            filename="COMPETITION_DESC.md",
-            use_auth_token=self.autotrain_token,
-            repo_type="dataset",
-        )
-        dataset_desc = hf_hub_download(
-            repo_id=self.competition_id,
-            filename="DATASET_DESC.md",
-            use_auth_token=self.autotrain_token,
-            repo_type="dataset",
-        )
-        self.config = self.load_config(config_fname)
-        self.competition_desc = self.load_md(competition_desc)
-        self.dataset_desc = self.load_md(dataset_desc)
-        try:
-            submission_desc = hf_hub_download(
-                repo_id=self.competition_id,
-                filename="SUBMISSION_DESC.md",
-                use_auth_token=self.autotrain_token,
-                repo_type="dataset",
-            )
-            self.submission_desc = self.load_md(submission_desc)
-        except Exception:
-            self.submission_desc = None
-
-        try:
-            rules_md = hf_hub_download(
-                repo_id=self.competition_id,
-                filename="RULES.md",
-                use_auth_token=self.autotrain_token,
-                repo_type="dataset",
-            )
-            self.rules_md = self.load_md(rules_md)
-        except Exception:
-            self.rules_md = None
+        # fetch all files concurrently, so a cold start costs the slowest download instead of the sum
+        with ThreadPoolExecutor(max_workers=len(COMPETITION_INFO_FILES)) as executor:
+            config_fname = executor.submit(self._download_file, "conf.json")
+            competition_desc = executor.submit(self._download_file, "COMPETITION_DESC.md")
+            dataset_desc = executor.submit(self._download_file, "DATASET_DESC.md")
+            submission_desc = executor.submit(self._download_optional_file, "SUBMISSION_DESC.md")
+            rules_md = executor.submit(self._download_optional_file, "RULES.md")
+
+        self.config = self.load_config(config_fname.result())
+        self.competition_desc = self.load_md(competition_desc.result())
+        self.dataset_desc = self.load_md(dataset_desc.result())
+        self.submission_desc = self.load_md(submission_desc.result()) if submission_desc.result() else None
+        self.rules_md = self.load_md(rules_md.result()) if rules_md.result() else None
 
         if self.config["EVAL_METRIC"] == "custom":
             if "SCORING_METRIC" not in self.config:
@@ -61,6 +49,19 @@ class CompetitionInfo:
                     "For custom metrics, please provide a single SCORING_METRIC name in the competition config file: conf.json"
                 )
 
+    def _download_file(self, filename):
+        return hub.download(self.competition_id, filename, self.autotrain_token)
+
+    def _download_optional_file(self, filename):
+        if self.available_files is not None:
+            if filename not in self.available_files:
+                return None
+            return self._download_file(filename)
+        try:
+            return self._download_file(filename)
+        except EntryNotFoundError:
+            return None
+
     def load_md(self, md_path):
         with open(md_path, "r", encoding="utf-8") as f:
             md = f.read()
@@ -165,33 +166,77 @@ class CompetitionInfo:
     def rules(self):
         return self.rules_md
 
-    def _save_md(self, md, filename, api):
+    def _save_md(self, md, filename, token):
         md = io.BytesIO(md.encode())
-        api.upload_file(
-            path_or_fileobj=md,
-            path_in_repo=filename,
-            repo_id=self.competition_id,
-            repo_type="dataset",
-        )
+        hub.upload(self.competition_id, filename, md, token)
 
     def update_competition_info(self, config, markdowns, token):
-        api = HfApi(token=token)
-        conf_json = json.dumps(config, indent=4)
-        conf_json_bytes = conf_json.encode("utf-8")
-        conf_json_buffer = io.BytesIO(conf_json_bytes)
-        api.upload_file(
-            path_or_fileobj=conf_json_buffer,
-            path_in_repo="conf.json",
-            repo_id=self.competition_id,
-            repo_type="dataset",
-        )
+        hub.upload_json(self.competition_id, "conf.json", config, token)
 
         competition_desc = markdowns["competition_desc"]
         dataset_desc = markdowns["dataset_desc"]
         submission_desc = markdowns["submission_desc"]
         rules_md = markdowns["rules"]
 
-        self._save_md(competition_desc, "COMPETITION_DESC.md", api)
-        self._save_md(dataset_desc, "DATASET_DESC.md", api)
-        self._save_md(submission_desc, "SUBMISSION_DESC.md", api)
-        self._save_md(rules_md, "RULES.md", api)
+        self._save_md(competition_desc, "COMPETITION_DESC.md", token)
+        self._save_md(dataset_desc, "DATASET_DESC.md", token)
+        self._save_md(submission_desc, "SUBMISSION_DESC.md", token)
+        self._save_md(rules_md, "RULES.md", token)
+        invalidate_competition_info(self.competition_id)
+
+
+@dataclass
+class _CachedCompetitionInfo:
+    info: CompetitionInfo
+    checked_at: float
+
+
+_COMPETITION_INFO_CACHE: Dict[str, _CachedCompetitionInfo] = {}
+_COMPETITION_INFO_CACHE_LOCK = threading.Lock()
+
+
+def _competition_info_revision(competition_id, token):
+    # a single call returns the blob ids of all the files CompetitionInfo is built from, unlike the repo sha
+    # it does not change every time a submission is made
+    blob_ids = hub.paths_info(competition_id, COMPETITION_INFO_FILES, token)
+    revision = hashlib.sha256(",".join(sorted(f"{k}:{v}" for k, v in blob_ids.items())).encode()).hexdigest()
+    return revision, list(blob_ids)
+
+
+def get_competition_info(competition_id, autotrain_token):
+    """
+    Return a process-wide CompetitionInfo for the competition.
+
+    The cached instance is revalidated against the Hub at most once every COMPETITION_INFO_TTL seconds and only
+    rebuilt if one of the competition files has changed.
+    """
+    with _COMPETITION_INFO_CACHE_LOCK:
+        cached = _COMPETITION_INFO_CACHE.get(competition_id)
+        if cached is not None and time.time() - cached.checked_at < COMPETITION_INFO_TTL:
+            return cached.info
+
+        try:
+            revision, available_files = _competition_info_revision(competition_id, autotrain_token)
+        except Exception as e:
+            if cached is None:
+                raise
+            logger.warning(f"Failed to revalidate competition info, serving cached version: {e}")
+            cached.checked_at = time.time()
+            return cached.info
+
+        if cached is None or cached.info.revision != revision:
+            info = CompetitionInfo(
+                competition_id=competition_id,
+                autotrain_token=autotrain_token,
+                revision=revision,
+                available_files=available_files,
+            )
+            cached = _CachedCompetitionInfo(info=info, checked_at=time.time())
+            _COMPETITION_INFO_CACHE[competition_id] = cached
+        cached.checked_at = time.time()
+        return cached.info
+
+
+def invalidate_competition_info(competition_id):
+    with _COMPETITION_INFO_CACHE_LOCK:
+        _COMPETITION_INFO_CACHE.pop(competition_id, None)
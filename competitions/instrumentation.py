@@ -0,0 +1,256 @@
+import atexit
+import bisect
+import contextlib
+import glob
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+# observations of child processes, e.g. the scoring workers and the evaluation subprocesses, are written to this
+# directory and merged into the metrics of the process that created it with `setup`
+METRICS_DIR = os.environ.get("METRICS_DIR")
+_OWNS_METRICS_DIR = False
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600)
+
+_HISTOGRAMS = {}
+_CALLBACKS = {}
+_LOCK = threading.Lock()
+
+
+def _new_metrics_file():
+    if METRICS_DIR is None:
+        return None
+    return os.path.join(METRICS_DIR, f"{os.getpid()}-{time.time_ns()}.json")
+
+
+_METRICS_FILE = _new_metrics_file()
+
+
+def setup():
+    """Create the metrics directory of this process, to export the metrics of the children it starts afterwards."""
+    global METRICS_DIR, _METRICS_FILE, _OWNS_METRICS_DIR
+    if METRICS_DIR is not None:
+        return
+    METRICS_DIR = tempfile.mkdtemp(prefix="competitions-metrics-")
+    _METRICS_FILE = _new_metrics_file()
+    _OWNS_METRICS_DIR = True
+
+
+def set_metrics_dir(metrics_dir):
+    """Write the observations of this process to `metrics_dir`, e.g. as the initializer of a pool worker."""
+    global METRICS_DIR, _METRICS_FILE
+    METRICS_DIR = metrics_dir
+    _METRICS_FILE = _new_metrics_file()
+
+
+def child_env():
+    """Environment of a subprocess, which writes its observations to the metrics directory of this process."""
+    env = os.environ.copy()
+    if METRICS_DIR is not None:
+        env["METRICS_DIR"] = METRICS_DIR
+    return env
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    """
+    Distribution of observed durations, exported as a prometheus histogram.
+
+    `labelnames` are the labels every observation is made with, each combination of label values is its own series.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts, sum, count]
+        self._series = {}
+        with _LOCK:
+            _HISTOGRAMS[name] = self
+
+    def observe(self, value, **labels):
+        label_values = tuple(str(labels[k]) for k in self.labelnames)
+        with _LOCK:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            bucket = bisect.bisect_left(self.buckets, value)
+            if bucket < len(self.buckets):
+                series[0][bucket] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def _merge(self, series, other_series):
+        for label_values, counts, total, count in other_series:
+            label_values = tuple(label_values)
+            current = series.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            current[0] = [a + b for a, b in zip(current[0], counts)]
+            current[1] += total
+            current[2] += count
+
+    def _render(self, series):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(series.items()):
+            labels = list(zip(self.labelnames, label_values))
+            cumulative = 0
+            for le, bucket_count in zip(self.buckets + (float("inf"),), counts + [count - sum(counts)]):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', _format_value(le))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+def register_callback(name, documentation, metric_type, callback, labelnames=()):
+    """
+    Export the value of a gauge or counter that is only known when the metrics are collected.
+
+    `callback` returns a number, or a dict mapping a tuple of `labelnames` values to a number.
+    """
+    with _LOCK:
+        _CALLBACKS[name] = (documentation, metric_type, callback, tuple(labelnames))
+
+
+def _snapshot():
+    with _LOCK:
+        return {
+            name: [[list(k), list(v[0]), v[1], v[2]] for k, v in histogram._series.items()]
+            for name, histogram in _HISTOGRAMS.items()
+            if histogram._series
+        }
+
+
+def flush(final=False):
+    """
+    Write the observations of this process to the metrics directory, for the process exporting the metrics.
+
+    A final file is absorbed and removed by the exporting process, the process must not observe anything afterwards.
+    """
+    state = _snapshot()
+    if not state or METRICS_DIR is None:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    tmp_path = f"{_METRICS_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"final": final, "histograms": state}, f)
+    os.replace(tmp_path, _METRICS_FILE)
+
+
+def _child_observations():
+    observations = []
+    if METRICS_DIR is None:
+        return observations
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        if path == _METRICS_FILE:
+            continue
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if state["final"]:
+            # a child that has exited is absorbed into this process, so that its file can go away
+            with _LOCK:
+                for name, other_series in state["histograms"].items():
+                    if name in _HISTOGRAMS:
+                        _HISTOGRAMS[name]._merge(_HISTOGRAMS[name]._series, other_series)
+            os.remove(path)
+        else:
+            observations.append(state["histograms"])
+    return observations
+
+
+def render():
+    """All the metrics of this process and its children, in the prometheus text format."""
+    children = _child_observations()
+    lines = []
+    with _LOCK:
+        histograms = list(_HISTOGRAMS.values())
+        callbacks = list(_CALLBACKS.items())
+    for histogram in histograms:
+        with _LOCK:
+            series = {k: [list(v[0]), v[1], v[2]] for k, v in histogram._series.items()}
+        for child in children:
+            histogram._merge(series, child.get(histogram.name, []))
+        lines.extend(histogram._render(series))
+
+    for name, (documentation, metric_type, callback, labelnames) in callbacks:
+        lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"])
+        values = callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{name}{_format_labels(list(zip(labelnames, label_values)))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _cleanup():
+    if _OWNS_METRICS_DIR:
+        shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    else:
+        flush(final=True)
+
+
+def _reset_after_fork():
+    # a forked child starts without the observations of its parent, they are exported by the parent already
+    global _LOCK, _METRICS_FILE, _OWNS_METRICS_DIR
+    _LOCK = threading.Lock()
+    _METRICS_FILE = _new_metrics_file()
+    _OWNS_METRICS_DIR = False
+    for histogram in _HISTOGRAMS.values():
+        histogram._series = {}
+
+
+atexit.register(_cleanup)
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+HUB_REQUEST_SECONDS = Histogram(
+    "competitions_hub_request_seconds",
+    "Duration of hub requests, by operation.",
+    ["operation"],
+)
+WHOAMI_SECONDS = Histogram(
+    "competitions_whoami_seconds",
+    "Duration of the requests resolving a token to its user.",
+)
+LEADERBOARD_BUILD_SECONDS = Histogram(
+    "competitions_leaderboard_build_seconds",
+    "Duration of the leaderboard build steps: download of the changed teams, parsing and ranking.",
+    ["step"],
+)
+EVALUATION_STAGE_SECONDS = Histogram(
+    "competitions_evaluation_stage_seconds",
+    "Duration of the evaluation stages of a submission: download, requirements, script, scoring and upload.",
+    ["stage"],
+)
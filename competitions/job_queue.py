@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from competitions.instrumentation import register_callback
+
+
+@dataclass(order=True)
+class PendingSubmission:
+    datetime: str
+    team_id: str = field(compare=False)
+    submission_id: str = field(compare=False)
+    submission_repo: str = field(default="", compare=False)
+    space_id: str = field(default="", compare=False)
+    queued_at: float = field(default_factory=time.time, compare=False)
+
+
+# put in the queue to wake up a waiting `get`, it sorts before every submission
+_WAKE_UP = PendingSubmission(datetime="", team_id="", submission_id="")
+
+
+class PendingQueue:
+    """
+    In-process queue of submissions waiting to be evaluated, oldest submission first.
+
+    A submission stays known to the queue from `put` until `done`, so the same submission is never dispatched twice
+    even if it is pushed again, e.g. by the startup scan.
+    """
+
+    def __init__(self):
+        self._queue = queue.PriorityQueue()
+        self._submission_ids = set()
+        self._wake_ups = 0
+        self._lock = threading.Lock()
+
+    def put(self, submission):
+        with self._lock:
+            if submission.submission_id in self._submission_ids:
+                return False
+            self._submission_ids.add(submission.submission_id)
+        self._queue.put(submission)
+        return True
+
+    def get(self, timeout=None):
+        try:
+            submission = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if submission is _WAKE_UP:
+            with self._lock:
+                self._wake_ups -= 1
+            return None
+        return submission
+
+    def wake_up(self):
+        """Make a waiting `get` return None right away, e.g. for its consumer to notice it has to stop."""
+        with self._lock:
+            self._wake_ups += 1
+        self._queue.put(_WAKE_UP)
+
+    def done(self, submission):
+        with self._lock:
+            self._submission_ids.discard(submission.submission_id)
+
+    def oldest(self):
+        """The oldest submission waiting in the queue, None if the queue is empty."""
+        with self._queue.mutex:
+            return min((submission for submission in self._queue.queue if submission is not _WAKE_UP), default=None)
+
+    def __len__(self):
+        with self._lock:
+            return self._queue.qsize() - self._wake_ups
+
+
+PENDING_SUBMISSIONS = PendingQueue()
+
+
+def _oldest_pending_age():
+    oldest = PENDING_SUBMISSIONS.oldest()
+    if oldest is None:
+        return 0
+    return (datetime.now() - datetime.strptime(oldest.datetime, "%Y-%m-%d %H:%M:%S")).total_seconds()
+
+
+register_callback(
+    "competitions_queue_depth",
+    "Submissions waiting to be evaluated by this process.",
+    "gauge",
+    lambda: len(PENDING_SUBMISSIONS),
+)
+register_callback(
+    "competitions_queue_oldest_age_seconds",
+    "Time since the oldest submission waiting to be evaluated was made, 0 if none is waiting.",
+    "gauge",
+    _oldest_pending_age,
+)
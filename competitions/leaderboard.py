@@ -1,15 +1,135 @@
-import glob
+import hashlib
+import itertools
 import json
 import os
+import threading
 import time
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Dict, Optional
 
+import numpy as np
 import pandas as pd
-from huggingface_hub import hf_hub_download, snapshot_download
 from loguru import logger
 
 from competitions.enums import SubmissionStatus
+from competitions.instrumentation import LEADERBOARD_BUILD_SECONDS
+from competitions.ranking import best_per_team, select_private_submissions
+from competitions.state import get_state_store
+
+
+LEADERBOARD_CACHE_DIR = os.environ.get("LEADERBOARD_CACHE_DIR", "/tmp/leaderboard")
+LEADERBOARD_REFRESH_INTERVAL = float(os.environ.get("LEADERBOARD_REFRESH_INTERVAL", 10))
+
+
+def parse_team_submissions(submission_info):
+    """Extract the successful submissions of a team file as columns."""
+    submissions = [sub for sub in submission_info["submissions"] if sub["status"] == SubmissionStatus.SUCCESS.value]
+    team_columns = {
+        "id": submission_info["id"],
+        "datetime": [sub["datetime"] for sub in submissions],
+        "selected": [bool(sub["selected"]) for sub in submissions],
+    }
+    for split in ("public", "private"):
+        metrics = {k for sub in submissions for k in sub[f"{split}_score"]}
+        team_columns[split] = {k: [sub[f"{split}_score"].get(k) for sub in submissions] for k in sorted(metrics)}
+    return team_columns
+
+
+@dataclass
+class SubmissionIndex:
+    """Columnar view of the successful submissions of all teams."""
+
+    team_ids: np.ndarray
+    team_idx: np.ndarray
+    datetime: np.ndarray
+    selected: np.ndarray
+    public: Dict[str, np.ndarray]
+    private: Dict[str, np.ndarray]
+
+    @classmethod
+    def from_team_columns(cls, teams):
+        teams = list(teams)
+        lengths = [len(team["datetime"]) for team in teams]
+        num_rows = sum(lengths)
+
+        def _concat(key):
+            return list(itertools.chain.from_iterable(team[key] for team in teams))
+
+        def _scores(split):
+            metrics = sorted({k for team in teams for k in team[split]})
+            return {
+                k: np.array(
+                    list(
+                        itertools.chain.from_iterable(
+                            team[split].get(k, [None] * length) for team, length in zip(teams, lengths)
+                        )
+                    ),
+                    dtype=np.float64,
+                )
+                for k in metrics
+            }
+
+        return cls(
+            team_ids=np.array([team["id"] for team in teams], dtype=object),
+            team_idx=np.repeat(np.arange(len(teams)), lengths),
+            datetime=np.array(_concat("datetime"), dtype="datetime64[s]").astype(np.int64),
+            selected=np.fromiter(_concat("selected"), dtype=bool, count=num_rows),
+            public=_scores("public"),
+            private=_scores("private"),
+        )
+
+    def __len__(self):
+        return len(self.team_idx)
+
+
+@dataclass
+class MaterializedLeaderboard:
+    # version of the competition state this leaderboard was built from
+    sha: Optional[str] = None
+    # version of the submissions of every team at `sha`
+    versions: Dict[str, str] = field(default_factory=dict)
+    # successful submissions of every team, keyed by team id
+    teams: Dict[str, dict] = field(default_factory=dict)
+    # index and ranked dataframes for `sha`, only kept in memory. a state is never changed to another sha, the
+    # rankings of a state are always the ones of its teams
+    index: Optional[SubmissionIndex] = None
+    rankings: Dict[tuple, pd.DataFrame] = field(default_factory=dict)
+    checked_at: float = 0.0
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        state = {
+            "sha": self.sha,
+            "versions": self.versions,
+            "teams": self.teams,
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            return cls(sha=state["sha"], versions=state["versions"], teams=state["teams"])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable leaderboard cache {path}: {e}")
+            return cls()
+
+    def get_index(self):
+        if self.index is None:
+            self.index = SubmissionIndex.from_team_columns(self.teams.values())
+        return self.index
+
+
+_MATERIALIZED_LEADERBOARDS: Dict[str, MaterializedLeaderboard] = {}
+_MATERIALIZED_LEADERBOARDS_LOCK = threading.Lock()
 
 
 @dataclass
@@ -24,144 +144,106 @@ class Leaderboard:
     def __post_init__(self):
         self.non_score_columns = ["id", "submission_datetime"]
 
-    def _process_public_lb(self):
-        start_time = time.time()
-        submissions_folder = snapshot_download(
-            repo_id=self.competition_id,
-            allow_patterns="submission_info/*.json",
-            use_auth_token=self.token,
-            repo_type="dataset",
+    @property
+    def _cache_path(self):
+        return os.path.join(LEADERBOARD_CACHE_DIR, f"{self.competition_id.replace('/', '--')}.json")
+
+    def _process_public_lb(self, index):
+        end_date = np.datetime64(self.end_date, "s").astype(np.int64)
+        best_rows = best_per_team(
+            index.team_idx,
+            index.public[self.scoring_metric],
+            index.datetime,
+            rows=np.flatnonzero(index.datetime < end_date),
+            higher_is_better=self.eval_higher_is_better,
         )
-        logger.info(f"Downloaded submissions in {time.time() - start_time} seconds")
-        start_time = time.time()
-        submissions = []
-        for submission in glob.glob(os.path.join(submissions_folder, "submission_info", "*.json")):
-            with open(submission, "r", encoding="utf-8") as f:
-                submission_info = json.load(f)
-            # only select submissions that are done
-            submission_info["submissions"] = [
-                sub for sub in submission_info["submissions"] if sub["status"] == SubmissionStatus.SUCCESS.value
-            ]
-            submission_info["submissions"] = [
-                sub
-                for sub in submission_info["submissions"]
-                if datetime.strptime(sub["datetime"], "%Y-%m-%d %H:%M:%S") < self.end_date
-            ]
-            if len(submission_info["submissions"]) == 0:
-                continue
+        return best_rows, index.public
 
-            user_id = submission_info["id"]
-            user_submissions = []
-            for sub in submission_info["submissions"]:
-                _sub = {
-                    "id": user_id,
-                    # "submission_id": sub["submission_id"],
-                    # "submission_comment": sub["submission_comment"],
-                    # "status": sub["status"],
-                    # "selected": sub["selected"],
-                }
-                for k, v in sub["public_score"].items():
-                    _sub[k] = v
-                _sub["submission_datetime"] = sub["datetime"]
-                user_submissions.append(_sub)
-
-            user_submissions.sort(key=lambda x: x[self.scoring_metric], reverse=self.eval_higher_is_better)
-            best_user_submission = user_submissions[0]
-            submissions.append(best_user_submission)
-        logger.info(f"Processed submissions in {time.time() - start_time} seconds")
-        return submissions
-
-    def _process_private_lb(self):
-        start_time = time.time()
-        submissions_folder = snapshot_download(
-            repo_id=self.competition_id,
-            allow_patterns="submission_info/*.json",
-            use_auth_token=self.token,
-            repo_type="dataset",
+    def _process_private_lb(self, index):
+        best_rows, skipped_teams = select_private_submissions(
+            index.team_idx,
+            index.public[self.scoring_metric],
+            index.private[self.scoring_metric],
+            index.selected,
+            index.datetime,
+            max_selected_submissions=self.max_selected_submissions,
+            higher_is_better=self.eval_higher_is_better,
         )
-        logger.info(f"Downloaded submissions in {time.time() - start_time} seconds")
+        for team_id in index.team_ids[skipped_teams]:
+            logger.warning(
+                f"User {team_id} has more than {self.max_selected_submissions} selected submissions. Skipping user..."
+            )
+        return best_rows, index.private
+
+    def _refresh(self, state):
+        """
+        Return the leaderboard state at the current version of the competition state.
+
+        A new version gets a new state object, so that a ranking computed from a previous state is never stored under
+        the new version.
+        """
+        store = get_state_store(self.competition_id, self.token)
+        sha = store.version()
+        state.checked_at = time.time()
+        if sha == state.sha:
+            return state
+
         start_time = time.time()
-        submissions = []
-        for submission in glob.glob(os.path.join(submissions_folder, "submission_info", "*.json")):
-            with open(submission, "r", encoding="utf-8") as f:
-                submission_info = json.load(f)
-                submission_info["submissions"] = [
-                    sub for sub in submission_info["submissions"] if sub["status"] == SubmissionStatus.SUCCESS.value
-                ]
-                if len(submission_info["submissions"]) == 0:
-                    continue
-
-                user_id = submission_info["id"]
-                user_submissions = []
-                for sub in submission_info["submissions"]:
-                    _sub = {
-                        "id": user_id,
-                        # "submission_id": sub["submission_id"],
-                        # "submission_comment": sub["submission_comment"],
-                        # "status": sub["status"],
-                        "selected": sub["selected"],
-                    }
-                    for k, v in sub["public_score"].items():
-                        _sub[f"public_{k}"] = v
-                    for k, v in sub["private_score"].items():
-                        _sub[f"private_{k}"] = v
-                    _sub["submission_datetime"] = sub["datetime"]
-                    user_submissions.append(_sub)
-
-                # count the number of submissions which are selected
-                selected_submissions = 0
-                for sub in user_submissions:
-                    if sub["selected"]:
-                        selected_submissions += 1
-
-                if selected_submissions == 0:
-                    # select submissions with best public score
-                    user_submissions.sort(
-                        key=lambda x: x[f"public_{self.scoring_metric}"], reverse=self.eval_higher_is_better
-                    )
-                    # select only the best submission
-                    best_user_submission = user_submissions[0]
-
-                elif selected_submissions <= self.max_selected_submissions:
-                    # select only the selected submissions
-                    user_submissions = [sub for sub in user_submissions if sub["selected"]]
-                    # sort by private score
-                    user_submissions.sort(
-                        key=lambda x: x[f"private_{self.scoring_metric}"], reverse=self.eval_higher_is_better
-                    )
-                    # select only the best submission
-                    best_user_submission = user_submissions[0]
-                else:
-                    logger.warning(
-                        f"User {user_id} has more than {self.max_selected_submissions} selected submissions. Skipping user..."
-                    )
-                    continue
-
-                # remove all keys that start with "public_"
-                best_user_submission = {k: v for k, v in best_user_submission.items() if not k.startswith("public_")}
-
-                # remove private_ from the keys
-                best_user_submission = {k.replace("private_", ""): v for k, v in best_user_submission.items()}
-
-                # remove selected key
-                best_user_submission.pop("selected")
-                submissions.append(best_user_submission)
-        logger.info(f"Processed submissions in {time.time() - start_time} seconds")
-        return submissions
+        versions = store.team_versions(revision=sha)
+        changed_teams = [team_id for team_id, version in versions.items() if state.versions.get(team_id) != version]
+        removed_teams = [team_id for team_id in state.versions if team_id not in versions]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            submission_infos = list(
+                executor.map(lambda team_id: store.get_team_submissions(team_id, revision=sha), changed_teams)
+            )
+        elapsed = time.time() - start_time
+        LEADERBOARD_BUILD_SECONDS.observe(elapsed, step="download")
+        logger.info(f"Downloaded {len(changed_teams)} changed submissions in {elapsed} seconds")
+
+        start_time = time.time()
+        teams = dict(state.teams)
+        for team_id, submission_info in zip(changed_teams, submission_infos):
+            teams[team_id] = parse_team_submissions(submission_info)
+        for team_id in removed_teams:
+            teams.pop(team_id, None)
+        elapsed = time.time() - start_time
+        LEADERBOARD_BUILD_SECONDS.observe(elapsed, step="parse")
+        logger.info(f"Processed submissions in {elapsed} seconds")
+
+        state = MaterializedLeaderboard(sha=sha, versions=versions, teams=teams, checked_at=state.checked_at)
+        try:
+            state.save(self._cache_path)
+        except OSError as e:
+            logger.warning(f"Failed to save leaderboard cache: {e}")
+        return state
+
+    def _materialize(self):
+        with _MATERIALIZED_LEADERBOARDS_LOCK:
+            state = _MATERIALIZED_LEADERBOARDS.get(self.competition_id)
+            if state is None:
+                state = MaterializedLeaderboard.load(self._cache_path)
+            if state.sha is None or time.time() - state.checked_at >= LEADERBOARD_REFRESH_INTERVAL:
+                state = self._refresh(state)
+            _MATERIALIZED_LEADERBOARDS[self.competition_id] = state
+            return state
+
+    def _rank(self, index, private, sha):
+        if len(index) == 0 or self.scoring_metric not in index.public or self.scoring_metric not in index.private:
+            return pd.DataFrame()
 
-    def fetch(self, private=False):
         if private:
-            submissions = self._process_private_lb()
+            best_rows, scores = self._process_private_lb(index)
         else:
-            submissions = self._process_public_lb()
+            best_rows, scores = self._process_public_lb(index)
 
-        if len(submissions) == 0:
+        if len(best_rows) == 0:
             return pd.DataFrame()
 
-        df = pd.DataFrame(submissions)
-
-        # convert submission datetime to pandas datetime
-        df["submission_datetime"] = pd.to_datetime(df["submission_datetime"], format="%Y-%m-%d %H:%M:%S")
+        df = pd.DataFrame({"id": index.team_ids[index.team_idx[best_rows]]})
+        for k, v in scores.items():
+            if not np.isnan(v[best_rows]).all():
+                df[k] = v[best_rows]
+        df["submission_datetime"] = index.datetime[best_rows].astype("datetime64[s]")
 
         # only keep submissions before the end date
         df = df[df["submission_datetime"] < self.end_date].reset_index(drop=True)
@@ -216,15 +298,46 @@ class Leaderboard:
         columns = ["rank"] + columns
         df = df[columns]
 
-        team_metadata = hf_hub_download(
-            repo_id=self.competition_id,
-            filename="teams.json",
-            token=self.token,
-            repo_type="dataset",
-        )
-        with open(team_metadata, "r", encoding="utf-8") as f:
-            team_metadata = json.load(f)
+        team_metadata = get_state_store(self.competition_id, self.token).get_teams(revision=sha)
 
+        # the team id is kept to find the row of a team, it is dropped from the returned leaderboards
+        df["team_id"] = df["id"]
         df["id"] = df["id"].apply(lambda x: team_metadata[x]["name"])
 
         return df
+
+    def _ranking(self, private):
+        state = self._materialize()
+        key = (private, self.end_date, self.eval_higher_is_better, self.max_selected_submissions, self.scoring_metric)
+        if key not in state.rankings:
+            with LEADERBOARD_BUILD_SECONDS.timer(step="rank"):
+                state.rankings[key] = self._rank(state.get_index(), private=private, sha=state.sha)
+        return state.sha, key, state.rankings[key]
+
+    def fetch(self, private=False):
+        _, _, ranking = self._ranking(private)
+        return ranking.drop(columns=["team_id"], errors="ignore")
+
+    def fetch_page(self, private=False, offset=0, limit=50, team_id=None):
+        """
+        Return `limit` rows of the leaderboard starting at `offset`, as json records.
+
+        If `team_id` is given and the team is ranked, the page is centered on the row of the team instead. `version`
+        identifies the state and the ranking the page was taken from, it changes whenever the page could change.
+        """
+        sha, key, ranking = self._ranking(private)
+        if team_id is not None and len(ranking) > 0:
+            team_rows = np.flatnonzero(ranking["team_id"].to_numpy() == team_id)
+            if len(team_rows) > 0:
+                offset = max(int(team_rows[0]) - limit // 2, 0)
+
+        page = ranking.iloc[offset : offset + limit].drop(columns=["team_id"], errors="ignore")
+        # missing scores are sent as null
+        page = page.astype(object).where(page.notna(), None)
+        return {
+            "version": hashlib.sha256(repr((sha, key)).encode()).hexdigest(),
+            "total": len(ranking),
+            "offset": offset,
+            "limit": limit,
+            "rows": page.to_dict(orient="records"),
+        }
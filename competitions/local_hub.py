@@ -0,0 +1,222 @@
+import contextlib
+import fcntl
+import fnmatch
+import functools
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import requests
+from huggingface_hub.utils import HfHubHTTPError
+from huggingface_hub.utils._errors import EntryNotFoundError, RevisionNotFoundError
+
+
+def _error(cls, message, status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return cls(message, response=response)
+
+
+def _blob_id(content):
+    # same id as the hub, the git sha1 of the blob
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def _read_operation(operation):
+    path_or_fileobj = operation.path_or_fileobj
+    if isinstance(path_or_fileobj, bytes):
+        return path_or_fileobj
+    if isinstance(path_or_fileobj, str):
+        with open(path_or_fileobj, "rb") as f:
+            return f.read()
+    path_or_fileobj.seek(0)
+    return path_or_fileobj.read()
+
+
+def _write_atomic(path, content):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+class LocalRepo:
+    """
+    A hub repo stored in a local directory, with commits, revisions and blob ids like on the hub.
+
+    Files are stored once per blob under `.hub/objects`, every commit maps the paths of the repo to their blob ids.
+    Downloads are hard links at `.hub/blobs/<blob id>/<file name>`, so that the path of a file only changes with its
+    content, like the blob a huggingface_hub cache entry resolves to. Snapshots are hard links into
+    `.hub/snapshots/<commit>`, laid out like the huggingface_hub cache. The files present in the directory when the
+    repo is first used become its initial commit. Commits are serialized with a file lock, so several processes can
+    share the repo.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._hub_dir = os.path.join(path, ".hub")
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self._hub_dir, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(self._hub_dir, "commits"), exist_ok=True)
+        with self._locked():
+            if not os.path.exists(os.path.join(self._hub_dir, "HEAD")):
+                self._import_files()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock, open(os.path.join(self._hub_dir, "lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _import_files(self):
+        tree = {}
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = [d for d in dirs if d != ".hub"]
+            for name in files:
+                file_path = os.path.join(root, name)
+                with open(file_path, "rb") as f:
+                    tree[os.path.relpath(file_path, self.path)] = self._store(f.read())
+        self._write_commit(None, tree, "initial commit")
+
+    def _store(self, content):
+        blob_id = _blob_id(content)
+        object_path = os.path.join(self._hub_dir, "objects", blob_id)
+        if not os.path.exists(object_path):
+            _write_atomic(object_path, content)
+        return blob_id
+
+    def _write_commit(self, parent, tree, message):
+        commit = {"parent": parent, "tree": tree, "message": message, "time": time.time_ns()}
+        content = json.dumps(commit, sort_keys=True).encode("utf-8")
+        sha = hashlib.sha1(content).hexdigest()
+        _write_atomic(os.path.join(self._hub_dir, "commits", f"{sha}.json"), content)
+        _write_atomic(os.path.join(self._hub_dir, "HEAD"), sha.encode())
+        return sha
+
+    def head(self):
+        with open(os.path.join(self._hub_dir, "HEAD"), "r", encoding="utf-8") as f:
+            return f.read()
+
+    def _resolve(self, revision):
+        if revision is None or revision == "main":
+            return self.head()
+        return revision
+
+    @functools.lru_cache(maxsize=128)
+    def _tree(self, sha):
+        try:
+            with open(os.path.join(self._hub_dir, "commits", f"{sha}.json"), "r", encoding="utf-8") as f:
+                return json.load(f)["tree"]
+        except FileNotFoundError:
+            raise _error(RevisionNotFoundError, f"Revision {sha} not found in {self.path}", 404)
+
+    def tree(self, revision=None):
+        return self._tree(self._resolve(revision))
+
+    def _materialize(self, sha, path_in_repo, blob_id, local_dir=None):
+        if local_dir is None:
+            local_dir = os.path.join(self._hub_dir, "snapshots", sha)
+        file_path = os.path.join(local_dir, path_in_repo)
+        if not os.path.exists(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                os.link(os.path.join(self._hub_dir, "objects", blob_id), tmp_path)
+            except OSError:
+                shutil.copyfile(os.path.join(self._hub_dir, "objects", blob_id), tmp_path)
+            os.replace(tmp_path, file_path)
+        return file_path
+
+    def download(self, filename, revision=None):
+        sha = self._resolve(revision)
+        blob_id = self._tree(sha).get(filename)
+        if blob_id is None:
+            raise _error(EntryNotFoundError, f"{filename} not found in {self.path} at {sha}", 404)
+        return self._materialize(
+            sha, os.path.basename(filename), blob_id, local_dir=os.path.join(self._hub_dir, "blobs", blob_id)
+        )
+
+    def snapshot(self, allow_patterns=None, revision=None, local_dir=None):
+        sha = self._resolve(revision)
+        if isinstance(allow_patterns, str):
+            allow_patterns = [allow_patterns]
+        for path_in_repo, blob_id in self._tree(sha).items():
+            if allow_patterns is None or any(fnmatch.fnmatch(path_in_repo, p) for p in allow_patterns):
+                self._materialize(sha, path_in_repo, blob_id, local_dir=local_dir)
+        if local_dir is not None:
+            return local_dir
+        snapshot_dir = os.path.join(self._hub_dir, "snapshots", sha)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        return snapshot_dir
+
+    def commit(self, operations, commit_message, parent_commit=None):
+        """Add the files of `operations`, rejected with a 412 like on the hub if `parent_commit` is not the head."""
+        contents = {operation.path_in_repo: _read_operation(operation) for operation in operations}
+        with self._locked():
+            head = self.head()
+            if parent_commit is not None and parent_commit != head:
+                raise _error(HfHubHTTPError, f"A commit has happened since {parent_commit}", 412)
+            tree = dict(self._tree(head))
+            for path_in_repo, content in contents.items():
+                tree[path_in_repo] = self._store(content)
+            return self._write_commit(head, tree, commit_message)
+
+    def list_blobs(self, path_in_repo, revision=None):
+        path_in_repo = path_in_repo.strip("/")
+        return {
+            path: blob_id for path, blob_id in self.tree(revision).items() if os.path.dirname(path) == path_in_repo
+        }
+
+    def paths_info(self, paths):
+        tree = self.tree()
+        return {path: tree[path] for path in paths if path in tree}
+
+
+_REPOS = {}
+_REPOS_LOCK = threading.Lock()
+
+
+def get_repo(root, repo_id, repo_type="dataset"):
+    """Return the local repo `repo_id`, stored under `<root>/<repo_type>s/<repo_id>`."""
+    path = os.path.join(root, f"{repo_type}s", repo_id)
+    with _REPOS_LOCK:
+        if path not in _REPOS:
+            _REPOS[path] = LocalRepo(path)
+        return _REPOS[path]
+
+
+def local_user(token):
+    """Id and name of the user a token stands for, the same token is always the same user."""
+    user_id = hashlib.sha256(token.encode("utf-8")).hexdigest()[:24]
+    return user_id, f"user-{user_id[:8]}"
+
+
+def whoami_response(url, headers=None, cookies=None, **kwargs):
+    """
+    Answer whoami-v2 and oauth userinfo requests with the `local_user` of the token, every token is valid.
+
+    Load tests can simulate many users by generating tokens.
+    """
+    response = requests.Response()
+    response.url = url
+    auth = (headers or {}).get("Authorization", "")
+    token = auth[len("Bearer ") :] if auth.startswith("Bearer ") else (cookies or {}).get("token")
+    if not token or not url.endswith(("/api/whoami-v2", "/oauth/userinfo")):
+        response.status_code = 401 if not token else 404
+        response._content = json.dumps({"error": "Invalid request"}).encode("utf-8")
+        return response
+
+    user_id, user_name = local_user(token)
+    if url.endswith("/oauth/userinfo"):
+        user_info = {"sub": user_id, "preferred_username": user_name, "orgs": []}
+    else:
+        user_info = {"id": user_id, "name": user_name, "type": "user", "orgs": []}
+    response.status_code = 200
+    response._content = json.dumps(user_info).encode("utf-8")
+    return response
@@ -0,0 +1,62 @@
+import numpy as np
+
+
+def best_per_team(team_idx, scores, datetime, rows=None, higher_is_better=True):
+    """
+    Return the index of the best row of every team among `rows`.
+
+    Rows are ordered by team, score and submission datetime with a single `np.lexsort`, so ties on the
+    score go to the earliest submission. Rows without a score are ignored.
+    """
+    if rows is None:
+        rows = np.arange(len(team_idx))
+    rows = rows[~np.isnan(scores[rows])]
+    keys = -scores[rows] if higher_is_better else scores[rows]
+    rows = rows[np.lexsort((datetime[rows], keys, team_idx[rows]))]
+
+    teams = team_idx[rows]
+    first_of_team = np.ones(len(rows), dtype=bool)
+    first_of_team[1:] = teams[1:] != teams[:-1]
+    return rows[first_of_team]
+
+
+def select_private_submissions(
+    team_idx,
+    public,
+    private,
+    selected,
+    datetime,
+    max_selected_submissions,
+    higher_is_better=True,
+):
+    """
+    Pick the submission that counts for the private leaderboard for every team.
+
+    - a team without selected submissions is represented by its submission with the best public score
+    - a team with at most `max_selected_submissions` selected submissions is represented by the selected
+      submission with the best private score
+    - a team with more selected submissions than allowed is skipped
+
+    Returns the sorted indices of the chosen rows and the indices of the skipped teams.
+    """
+    num_teams = int(team_idx.max()) + 1 if len(team_idx) else 0
+    num_selected = np.bincount(team_idx[selected], minlength=num_teams)
+    team_num_selected = num_selected[team_idx]
+
+    unselected_rows = best_per_team(
+        team_idx,
+        public,
+        datetime,
+        rows=np.flatnonzero(team_num_selected == 0),
+        higher_is_better=higher_is_better,
+    )
+    selected_rows = best_per_team(
+        team_idx,
+        private,
+        datetime,
+        rows=np.flatnonzero(selected & (team_num_selected <= max_selected_submissions)),
+        higher_is_better=higher_is_better,
+    )
+    best_rows = np.sort(np.concatenate([unselected_rows, selected_rows]))
+    skipped_teams = np.flatnonzero(num_selected > max_selected_submissions)
+    return best_rows, skipped_teams
@@ -1,19 +1,39 @@
-import glob
 import io
 import json
+import multiprocessing
 import os
-import time
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass
 
 import pandas as pd
-from huggingface_hub import HfApi, hf_hub_download, snapshot_download
 from loguru import logger
 
+from competitions import hub, instrumentation
+from competitions.compute_metrics import compute_metrics
 from competitions.enums import SubmissionStatus
 from competitions.info import CompetitionInfo
-from competitions.utils import run_evaluation
+from competitions.job_queue import PENDING_SUBMISSIONS, PendingSubmission
+from competitions.params import EvalParams
+from competitions.state import check_state_backend, get_state_store
+from competitions.utils import (
+    run_evaluation,
+    update_submission_score,
+    update_submission_status,
+    update_team_submission,
+)
 
 
+EVAL_WORKERS = int(os.environ.get("EVAL_WORKERS", os.cpu_count() or 1))
+EVAL_TIMEOUT = int(os.environ.get("EVAL_TIMEOUT", 3600))
+
+# imported once by the forkserver, every scoring worker forked from it starts with them loaded
+_SCORING_PRELOAD = ["pandas", "sklearn.metrics", "huggingface_hub", "competitions.compute_metrics"]
+
 _DOCKERFILE = """
 FROM huggingface/competitions:latest
 
@@ -24,6 +44,33 @@ CMD uvicorn competitions.api:api --port 7860 --host 0.0.0.0
 _DOCKERFILE = _DOCKERFILE.replace("\n", " ").replace("  ", "\n").strip()
 
 
+def _scoring_context():
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(_SCORING_PRELOAD)
+    return context
+
+
+def _terminate_pool(pool):
+    # a running task cannot be cancelled, its worker is killed instead
+    if hasattr(pool, "terminate_workers"):
+        # python 3.14+
+        pool.terminate_workers()
+        return
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def score_submission(params):
+    try:
+        return compute_metrics(EvalParams(**params))
+    finally:
+        # the stage durations observed in this worker are exported by the parent process
+        instrumentation.flush()
+
+
 @dataclass
 class JobRunner:
     competition_id: str
@@ -41,30 +88,78 @@ class JobRunner:
         self.time_limit = self.competition_info.time_limit
         self.dataset = self.competition_info.dataset
         self.submission_filenames = self.competition_info.submission_filenames
+        self._eval_slots = threading.BoundedSemaphore(EVAL_WORKERS)
+        self._eval_executor = ThreadPoolExecutor(max_workers=EVAL_WORKERS, thread_name_prefix="eval")
+        self._stopped = threading.Event()
+        # set once the workers are stopped, the submissions they were evaluating are put back in the queue
+        self._shut_down = threading.Event()
+        # generic submissions are plain files scored with built-in metrics, no participant code is ever run, so they
+        # can be scored in warm worker processes instead of a new python process per submission. custom metrics are
+        # imported from the competition repo and keep running in their own process.
+        self._scoring_pool = None
+        self._scoring_pool_lock = threading.Lock()
+        if self.competition_type == "generic" and self.metric != "custom":
+            self._scoring_pool = self._new_scoring_pool()
+        check_state_backend(self.competition_type)
 
-    def get_pending_subs(self):
-        submission_jsons = snapshot_download(
-            repo_id=self.competition_id,
-            allow_patterns="submission_info/*.json",
-            token=self.token,
-            repo_type="dataset",
+    def _new_scoring_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=EVAL_WORKERS,
+            mp_context=_scoring_context(),
+            initializer=instrumentation.set_metrics_dir,
+            initargs=(instrumentation.METRICS_DIR,),
         )
-        submission_jsons = glob.glob(os.path.join(submission_jsons, "submission_info/*.json"))
-        pending_submissions = []
-        for _json in submission_jsons:
-            _json = json.load(open(_json, "r", encoding="utf-8"))
-            team_id = _json["id"]
-            for sub in _json["submissions"]:
-                if sub["status"] == SubmissionStatus.PENDING.value:
-                    pending_submissions.append(
-                        {
-                            "team_id": team_id,
-                            "submission_id": sub["submission_id"],
-                            "datetime": sub["datetime"],
-                            "submission_repo": sub["submission_repo"],
-                            "space_id": sub["space_id"],
-                        }
-                    )
+
+    def _replace_scoring_pool(self, pool):
+        with self._scoring_pool_lock:
+            if self._scoring_pool is pool:
+                _terminate_pool(pool)
+                self._scoring_pool = self._new_scoring_pool()
+
+    def _score(self, params):
+        with self._scoring_pool_lock:
+            pool = self._scoring_pool
+            if pool is None:
+                raise RuntimeError("Job runner is shut down")
+            future = pool.submit(score_submission, params)
+        try:
+            return future.result(timeout=EVAL_TIMEOUT)
+        except (BrokenProcessPool, FutureTimeoutError):
+            # a worker killed e.g. for running out of memory breaks the whole pool, and a timed out worker would keep
+            # its slot until it returns, the pool is replaced by a fresh one in both cases
+            self._replace_scoring_pool(pool)
+            raise
+
+    def shutdown(self):
+        """Stop the workers of this runner, e.g. before the watchdog replaces it."""
+        self._shut_down.set()
+        with self._scoring_pool_lock:
+            if self._scoring_pool is not None:
+                _terminate_pool(self._scoring_pool)
+                self._scoring_pool = None
+        self._eval_executor.shutdown(wait=False, cancel_futures=True)
+
+    def stop(self):
+        """Stop taking pending submissions and stop the workers, `run` returns right after."""
+        self._stopped.set()
+        PENDING_SUBMISSIONS.wake_up()
+        self.shutdown()
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def get_pending_subs(self):
+        pending_submissions = [
+            {
+                "team_id": sub["team_id"],
+                "submission_id": sub["submission_id"],
+                "datetime": sub["datetime"],
+                "submission_repo": sub["submission_repo"],
+                "space_id": sub["space_id"],
+            }
+            for sub in get_state_store(self.competition_id, self.token).pending_submissions()
+        ]
         if len(pending_submissions) == 0:
             return None
         logger.info(f"Found {len(pending_submissions)} pending submissions.")
@@ -75,60 +170,17 @@ class JobRunner:
         return pending_submissions
 
     def _queue_submission(self, team_id, submission_id):
-        team_fname = hf_hub_download(
-            repo_id=self.competition_id,
-            filename=f"submission_info/{team_id}.json",
-            token=self.token,
-            repo_type="dataset",
-        )
-        with open(team_fname, "r", encoding="utf-8") as f:
-            team_submission_info = json.load(f)
-
-        for submission in team_submission_info["submissions"]:
-            if submission["submission_id"] == submission_id:
-                submission["status"] = SubmissionStatus.QUEUED.value
-                break
-
-        team_submission_info_json = json.dumps(team_submission_info, indent=4)
-        team_submission_info_json_bytes = team_submission_info_json.encode("utf-8")
-        team_submission_info_json_buffer = io.BytesIO(team_submission_info_json_bytes)
-        api = HfApi(token=self.token)
-        api.upload_file(
-            path_or_fileobj=team_submission_info_json_buffer,
-            path_in_repo=f"submission_info/{team_id}.json",
-            repo_id=self.competition_id,
-            repo_type="dataset",
+        update_team_submission(
+            self.competition_id, team_id, submission_id, self.token, status=SubmissionStatus.QUEUED.value
         )
 
     def mark_submission_failed(self, team_id, submission_id):
-        team_fname = hf_hub_download(
-            repo_id=self.competition_id,
-            filename=f"submission_info/{team_id}.json",
-            token=self.token,
-            repo_type="dataset",
+        update_team_submission(
+            self.competition_id, team_id, submission_id, self.token, status=SubmissionStatus.FAILED.value
         )
-        with open(team_fname, "r", encoding="utf-8") as f:
-            team_submission_info = json.load(f)
 
-        for submission in team_submission_info["submissions"]:
-            if submission["submission_id"] == submission_id:
-                submission["status"] = SubmissionStatus.FAILED.value
-
-        team_submission_info_json = json.dumps(team_submission_info, indent=4)
-        team_submission_info_json_bytes = team_submission_info_json.encode("utf-8")
-        team_submission_info_json_buffer = io.BytesIO(team_submission_info_json_bytes)
-
-        api = HfApi(token=self.token)
-        api.upload_file(
-            path_or_fileobj=team_submission_info_json_buffer,
-            path_in_repo=f"submission_info/{team_id}.json",
-            repo_id=self.competition_id,
-            repo_type="dataset",
-        )
-
-    def run_local(self, team_id, submission_id, submission_repo):
-        self._queue_submission(team_id, submission_id)
-        eval_params = {
+    def _eval_params(self, team_id, submission_id, submission_repo, output_path):
+        return {
             "competition_id": self.competition_id,
             "competition_type": self.competition_type,
             "metric": self.metric,
@@ -138,15 +190,74 @@ class JobRunner:
             "submission_id_col": self.submission_id_col,
             "submission_cols": self.submission_cols,
             "submission_rows": self.submission_rows,
-            "output_path": self.output_path,
+            "output_path": output_path,
             "submission_repo": submission_repo,
             "time_limit": self.time_limit,
             "dataset": self.dataset,
             "submission_filenames": self.submission_filenames,
         }
-        eval_params = json.dumps(eval_params)
-        eval_pid = run_evaluation(eval_params, local=True, wait=True)
-        logger.info(f"New evaluation process started with pid {eval_pid}.")
+
+    def _score_in_process(self, team_id, submission_id, submission_repo):
+        eval_params = EvalParams(**self._eval_params(team_id, submission_id, submission_repo, self.output_path))
+        update_submission_status(eval_params, SubmissionStatus.PROCESSING.value)
+        try:
+            evaluation = self._score(eval_params.model_dump())
+        except BrokenProcessPool:
+            if self._shut_down.is_set():
+                raise
+            # the pool can have been broken by another submission, this one gets a second try on the new pool
+            logger.warning(f"Scoring pool broke while scoring submission {submission_id}, retrying once.")
+            evaluation = self._score(eval_params.model_dump())
+        with instrumentation.EVALUATION_STAGE_SECONDS.timer(stage="upload"):
+            update_submission_score(eval_params, evaluation["public_score"], evaluation["private_score"])
+            update_submission_status(eval_params, SubmissionStatus.SUCCESS.value)
+
+    def run_local(self, team_id, submission_id, submission_repo):
+        self._queue_submission(team_id, submission_id)
+        # the submission file can still be staged, and the evaluation process reads and writes the submission info on
+        # the hub, not through this process
+        hub.flush_commits()
+        if self._scoring_pool is not None:
+            self._score_in_process(team_id, submission_id, submission_repo)
+            return
+
+        # every evaluation gets its own output path, so that parallel jobs do not overwrite each other's params
+        output_path = os.path.join(self.output_path, submission_id)
+        eval_params = json.dumps(self._eval_params(team_id, submission_id, submission_repo, output_path))
+        try:
+            eval_pid = run_evaluation(eval_params, local=True, wait=True, timeout=EVAL_TIMEOUT)
+            logger.info(f"Evaluation process with pid {eval_pid} finished.")
+        finally:
+            shutil.rmtree(output_path, ignore_errors=True)
+
+    def _requeue(self, pending_submission):
+        update_team_submission(
+            self.competition_id,
+            pending_submission.team_id,
+            pending_submission.submission_id,
+            self.token,
+            status=SubmissionStatus.PENDING.value,
+        )
+        PENDING_SUBMISSIONS.put(pending_submission)
+
+    def _run_local_job(self, pending_submission):
+        team_id = pending_submission.team_id
+        submission_id = pending_submission.submission_id
+        try:
+            self.run_local(team_id, submission_id, pending_submission.submission_repo)
+        except Exception as e:
+            if self._shut_down.is_set():
+                # the workers were stopped under the submission, which is not the fault of the participant
+                logger.warning(f"Job runner shut down while evaluating submission {submission_id}, requeueing it.")
+                self._requeue(pending_submission)
+            elif isinstance(e, (subprocess.TimeoutExpired, FutureTimeoutError)):
+                logger.error(f"Evaluation of submission {submission_id} timed out after {EVAL_TIMEOUT} seconds.")
+                self.mark_submission_failed(team_id, submission_id)
+            else:
+                logger.error(f"Failed to evaluate submission {submission_id}: {e}")
+                self.mark_submission_failed(team_id, submission_id)
+        finally:
+            self._eval_slots.release()
 
     def _create_readme(self, project_name):
         _readme = "---\n"
@@ -162,7 +273,7 @@ class JobRunner:
         return _readme
 
     def create_space(self, team_id, submission_id, submission_repo, space_id):
-        api = HfApi(token=self.token)
+        api = hub.get_api(self.token)
         params = {
             "competition_id": self.competition_id,
             "competition_type": self.competition_type,
@@ -198,33 +309,55 @@ class JobRunner:
             repo_type="space",
         )
         self._queue_submission(team_id, submission_id)
+        hub.flush_commits()
+
+    def _recover_pending_subs(self):
+        # submissions are pushed to the queue when they are made, the repo only needs to be scanned for the ones
+        # left pending by a previous process
+        pending_submissions = self.get_pending_subs()
+        if pending_submissions is None:
+            return
+        for _, row in pending_submissions.iterrows():
+            PENDING_SUBMISSIONS.put(
+                PendingSubmission(
+                    datetime=row["datetime"].strftime("%Y-%m-%d %H:%M:%S"),
+                    team_id=row["team_id"],
+                    submission_id=row["submission_id"],
+                    submission_repo=row["submission_repo"],
+                    space_id=row["space_id"],
+                )
+            )
+
+    def _dispatch(self, pending_submission):
+        team_id = pending_submission.team_id
+        submission_id = pending_submission.submission_id
+        submission_repo = pending_submission.submission_repo
+        if self.competition_type == "generic":
+            # wait for a free worker before taking the submission, the remaining ones stay in the pending queue
+            self._eval_slots.acquire()
+            self._eval_executor.submit(self._run_local_job, pending_submission)
+        elif self.competition_type == "script":
+            space_id = pending_submission.space_id
+            try:
+                self.create_space(team_id, submission_id, submission_repo, space_id)
+            except Exception as e:
+                logger.error(f"Failed to create space for {team_id} {submission_id} {submission_repo} {space_id}: {e}")
+                # mark submission as failed
+                self.mark_submission_failed(team_id, submission_id)
+                logger.error(f"Marked submission {submission_id} as failed.")
 
     def run(self):
-        while True:
-            pending_submissions = self.get_pending_subs()
-            if pending_submissions is None:
-                time.sleep(5)
+        self._recover_pending_subs()
+        while not self.stopped:
+            pending_submission = PENDING_SUBMISSIONS.get(timeout=60)
+            if pending_submission is None:
                 continue
-            if self.competition_type == "generic":
-                for _, row in pending_submissions.iterrows():
-                    team_id = row["team_id"]
-                    submission_id = row["submission_id"]
-                    submission_repo = row["submission_repo"]
-                    self.run_local(team_id, submission_id, submission_repo)
-            elif self.competition_type == "script":
-                for _, row in pending_submissions.iterrows():
-                    team_id = row["team_id"]
-                    submission_id = row["submission_id"]
-                    submission_repo = row["submission_repo"]
-                    space_id = row["space_id"]
-                    try:
-                        self.create_space(team_id, submission_id, submission_repo, space_id)
-                    except Exception as e:
-                        logger.error(
-                            f"Failed to create space for {team_id} {submission_id} {submission_repo} {space_id}: {e}"
-                        )
-                        # mark submission as failed
-                        self.mark_submission_failed(team_id, submission_id)
-                        logger.error(f"Marked submission {submission_id} as failed.")
-                        continue
-            time.sleep(5)
+            try:
+                self._dispatch(pending_submission)
+            except RuntimeError:
+                # the executor takes no new jobs once the runner is stopped, the submission is still pending in the
+                # competition state for the next runner to recover
+                if not self.stopped:
+                    raise
+            finally:
+                PENDING_SUBMISSIONS.done(pending_submission)
@@ -0,0 +1,169 @@
+import functools
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from competitions import hub
+from competitions.errors import SubmissionValidationError
+
+
+SOLUTION_CACHE_SIZE = int(os.environ.get("SOLUTION_CACHE_SIZE", 4))
+# extra ids kept to report, a submission can have any number of them
+MAX_REPORTED_EXTRA_IDS = 100
+
+
+class IdCoverage:
+    """Ids of a submission read chunk by chunk, checked against the solution ids once every chunk is seen."""
+
+    def __init__(self, index):
+        self.index = index
+        self.covered = np.zeros(len(index), dtype=bool)
+        self.duplicate_ids = []
+        self.extra_ids = []
+        self.num_extra_ids = 0
+
+    def update(self, ids):
+        """Record a chunk of ids, returns the solution row of every id and the mask of ids found in the solution."""
+        positions = self.index.get_indexer(ids)
+        found = positions >= 0
+        extra_ids = ids[~found]
+        self.num_extra_ids += len(extra_ids)
+        self.extra_ids.extend(extra_ids[: MAX_REPORTED_EXTRA_IDS - len(self.extra_ids)].tolist())
+
+        ids = ids[found]
+        positions = positions[found]
+        duplicated = self.covered[positions] | pd.Series(positions).duplicated().to_numpy()
+        if duplicated.any():
+            self.duplicate_ids.extend(pd.unique(ids[duplicated]).tolist())
+        self.covered[positions] = True
+        return positions, found
+
+    def check(self):
+        missing_ids = self.index[~self.covered].tolist()
+        if missing_ids or self.duplicate_ids or self.num_extra_ids:
+            raise SubmissionValidationError(
+                missing_ids=missing_ids,
+                duplicate_ids=list(dict.fromkeys(self.duplicate_ids)),
+                extra_ids=self.extra_ids,
+                num_extra_ids=self.num_extra_ids,
+            )
+
+
+@dataclass
+class Solution:
+    id_col: str
+    target_cols: List[str]
+    # ids, targets and rows in the solution file of each split, sorted by id
+    public_ids: np.ndarray
+    public_targets: pd.DataFrame
+    public_rows: np.ndarray
+    private_ids: np.ndarray
+    private_targets: pd.DataFrame
+    private_rows: np.ndarray
+    # position of every id in the solution file
+    index: pd.Index
+
+    @classmethod
+    def from_dataframe(cls, solution_df, id_col):
+        solution_df = solution_df.reset_index(drop=True)
+        if solution_df[id_col].duplicated().any():
+            raise ValueError(f"Solution has duplicate values in the id column {id_col}")
+
+        target_cols = [col for col in solution_df.columns if col not in [id_col, "split"]]
+        splits = {}
+        for split in ("public", "private"):
+            split_df = solution_df[solution_df.split == split].sort_values(id_col)
+            splits[f"{split}_rows"] = split_df.index.to_numpy()
+            split_df = split_df.reset_index(drop=True)
+            splits[f"{split}_ids"] = split_df[id_col].to_numpy()
+            splits[f"{split}_targets"] = split_df[target_cols]
+        return cls(
+            id_col=id_col,
+            target_cols=target_cols,
+            index=pd.Index(solution_df[id_col]),
+            **splits,
+        )
+
+    def align(self, submission_df):
+        """
+        Align the predictions of a submission with the public and private targets.
+
+        Submission ids are looked up in the solution index in a single hash join, the submission has to contain
+        every id of the solution exactly once and nothing else.
+
+        Returns the public and private predictions, row for row with `public_targets` and `private_targets`.
+        """
+        submission_ids = submission_df[self.id_col]
+        positions = self.index.get_indexer(submission_ids)
+
+        duplicated = submission_ids.duplicated().to_numpy()
+        duplicate_ids = pd.unique(submission_ids[duplicated])
+        extra_ids = submission_ids[positions == -1].to_numpy()
+        covered = np.zeros(len(self.index), dtype=bool)
+        covered[positions[positions >= 0]] = True
+        missing_ids = self.index[~covered].to_numpy()
+        if len(duplicate_ids) or len(extra_ids) or len(missing_ids):
+            raise SubmissionValidationError(
+                missing_ids=missing_ids.tolist(),
+                duplicate_ids=duplicate_ids.tolist(),
+                extra_ids=extra_ids.tolist(),
+            )
+
+        # submission row holding the prediction of every solution row
+        submission_rows = np.empty(len(self.index), dtype=np.int64)
+        submission_rows[positions] = np.arange(len(positions))
+        predictions = submission_df[self.target_cols]
+        public_predictions = predictions.iloc[submission_rows[self.public_rows]].reset_index(drop=True)
+        private_predictions = predictions.iloc[submission_rows[self.private_rows]].reset_index(drop=True)
+        return public_predictions, private_predictions
+
+    @functools.cached_property
+    def row_splits(self):
+        """Split of every solution row, 0 for public, 1 for private and -1 for rows in neither."""
+        row_splits = np.full(len(self.index), -1, dtype=np.int8)
+        row_splits[self.public_rows] = 0
+        row_splits[self.private_rows] = 1
+        return row_splits
+
+    @functools.cached_property
+    def row_targets(self):
+        """Target of every solution row, in solution file order. Only defined for a single target column."""
+        row_targets = np.empty(len(self.index), dtype=self.public_targets.dtypes.iloc[0])
+        row_targets[self.public_rows] = self.public_targets.iloc[:, 0].to_numpy()
+        row_targets[self.private_rows] = self.private_targets.iloc[:, 0].to_numpy()
+        return row_targets
+
+
+_SOLUTION_CACHE = OrderedDict()
+_SOLUTION_CACHE_LOCK = threading.Lock()
+
+
+def get_solution(competition_id, id_col, token):
+    """
+    Return the parsed solution of the competition.
+
+    The solution is parsed once per version of solution.csv: the key is the blob the hub cache resolved the file
+    to, so a new upload of the solution is picked up while repeated evaluations only pay for the download check.
+    """
+    solution_file = hub.download(competition_id, "solution.csv", token)
+    key = (competition_id, id_col, os.path.realpath(solution_file))
+    with _SOLUTION_CACHE_LOCK:
+        if key in _SOLUTION_CACHE:
+            _SOLUTION_CACHE.move_to_end(key)
+            return _SOLUTION_CACHE[key]
+
+    solution = Solution.from_dataframe(pd.read_csv(solution_file), id_col)
+    with _SOLUTION_CACHE_LOCK:
+        _SOLUTION_CACHE[key] = solution
+        while len(_SOLUTION_CACHE) > SOLUTION_CACHE_SIZE:
+            _SOLUTION_CACHE.popitem(last=False)
+    return solution
+
+
+def load_solution(params):
+    return get_solution(params.competition_id, params.submission_id_col, params.token)
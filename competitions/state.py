@@ -0,0 +1,481 @@
+import atexit
+import glob
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+from loguru import logger
+
+from competitions import hub
+from competitions.enums import SubmissionStatus
+from competitions.errors import SubmissionLimitError
+
+
+# "hub" keeps the state as json files in the competition repo, "sqlite" in a local database mirrored to the repo
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "hub").lower()
+STATE_DB_DIR = os.environ.get("STATE_DB_DIR", "/tmp/competitions")
+STATE_MIRROR_INTERVAL = float(os.environ.get("STATE_MIRROR_INTERVAL", 10))
+
+
+class StateStore(ABC):
+    """
+    Storage of the teams and submissions of a competition.
+
+    Team submissions are returned in the format of the `submission_info/{team_id}.json` files of the competition
+    repo: `{"id": team_id, "submissions": [...]}`. `version` and `team_versions` change whenever the state, or the
+    submissions of a team, change; `revision` pins the reads of the leaderboard to a version when the backend
+    supports it.
+    """
+
+    @abstractmethod
+    def version(self):
+        pass
+
+    @abstractmethod
+    def team_versions(self, revision=None):
+        pass
+
+    @abstractmethod
+    def get_user_team(self, user_id):
+        pass
+
+    @abstractmethod
+    def get_teams(self, revision=None):
+        pass
+
+    @abstractmethod
+    def get_team_submissions(self, team_id, revision=None):
+        pass
+
+    @abstractmethod
+    def pending_submissions(self):
+        pass
+
+    @abstractmethod
+    def create_team(self, team_id, user_id, user_name):
+        """Create a team for a user and return the id of the team of the user, which may have been created already."""
+
+    @abstractmethod
+    def rename_team(self, team_id, team_name):
+        pass
+
+    @abstractmethod
+    def add_submission(self, team_id, submission, submission_limit=None):
+        """
+        Add a submission to a team and return the number of submissions of the team on the day of the submission.
+
+        Raises `SubmissionLimitError`, and adds nothing, if the team already made `submission_limit` submissions that
+        day.
+        """
+
+    @abstractmethod
+    def update_submission(self, team_id, submission_id, **fields):
+        pass
+
+    @abstractmethod
+    def select_submissions(self, team_id, submission_ids):
+        pass
+
+
+def _submission_date(submission):
+    return submission["datetime"].split(" ")[0]
+
+
+class HubStateStore(StateStore):
+    """State as json files in the competition repo, written with `hub.update_json`."""
+
+    def __init__(self, competition_id, token):
+        self.competition_id = competition_id
+        self.token = token
+
+    def _update(self, path_in_repo, mutation):
+        return hub.update_json(self.competition_id, path_in_repo, mutation, self.token)
+
+    def version(self):
+        return hub.repo_sha(self.competition_id, self.token)
+
+    def team_versions(self, revision=None):
+        blobs = hub.list_blobs(self.competition_id, "submission_info", self.token, revision=revision)
+        return {
+            os.path.basename(path)[: -len(".json")]: blob_id
+            for path, blob_id in blobs.items()
+            if path.endswith(".json")
+        }
+
+    def get_user_team(self, user_id):
+        return hub.download_json(self.competition_id, "user_team.json", self.token).get(user_id)
+
+    def get_teams(self, revision=None):
+        return hub.download_json(self.competition_id, "teams.json", self.token, revision=revision)
+
+    def get_team_submissions(self, team_id, revision=None):
+        return hub.download_json(self.competition_id, f"submission_info/{team_id}.json", self.token, revision=revision)
+
+    def pending_submissions(self):
+        submission_jsons = hub.snapshot(self.competition_id, self.token, allow_patterns="submission_info/*.json")
+        submission_jsons = glob.glob(os.path.join(submission_jsons, "submission_info/*.json"))
+        pending_submissions = []
+        for _json in submission_jsons:
+            _json = json.load(open(_json, "r", encoding="utf-8"))
+            team_id = _json["id"]
+            for sub in _json["submissions"]:
+                if sub["status"] == SubmissionStatus.PENDING.value:
+                    pending_submissions.append(dict(sub, team_id=team_id))
+        return pending_submissions
+
+    def create_team(self, team_id, user_id, user_name):
+        def add_user(user_team):
+            user_team[user_id] = team_id
+            return user_team
+
+        def add_team(team_metadata):
+            team_metadata[team_id] = {
+                "id": team_id,
+                "name": user_name,
+                "members": [user_id],
+                "leader": user_id,
+            }
+            return team_metadata
+
+        def create_team_submission_info(_):
+            return {"id": team_id, "submissions": []}
+
+        self._update("user_team.json", add_user)
+        self._update("teams.json", add_team)
+        self._update(f"submission_info/{team_id}.json", create_team_submission_info)
+        return team_id
+
+    def rename_team(self, team_id, team_name):
+        def rename(team_metadata):
+            team_metadata[team_id]["name"] = team_name
+            return team_metadata
+
+        self._update("teams.json", rename)
+
+    def add_submission(self, team_id, submission, submission_limit=None):
+        date = _submission_date(submission)
+        checked = threading.Event()
+
+        def add(team_submission_info):
+            # the limit is checked against the content the submission is first added to, the mutation is applied
+            # again on a commit conflict or when the batched commit is flushed and must not fail then
+            if submission_limit is not None and not checked.is_set():
+                checked.set()
+                todays_submissions = sum(_submission_date(sub) == date for sub in team_submission_info["submissions"])
+                if todays_submissions >= submission_limit:
+                    raise SubmissionLimitError("Submission limit reached")
+            team_submission_info["submissions"].append(submission)
+            return team_submission_info
+
+        team_submission_info = self._update(f"submission_info/{team_id}.json", add)
+        return sum(_submission_date(sub) == date for sub in team_submission_info["submissions"])
+
+    def update_submission(self, team_id, submission_id, **fields):
+        def set_fields(team_submission_info):
+            for sub in team_submission_info["submissions"]:
+                if sub["submission_id"] == submission_id:
+                    sub.update(fields)
+                    break
+            return team_submission_info
+
+        self._update(f"submission_info/{team_id}.json", set_fields)
+
+    def select_submissions(self, team_id, submission_ids):
+        def select(team_submission_info):
+            for sub in team_submission_info["submissions"]:
+                sub["selected"] = sub["submission_id"] in submission_ids
+            return team_submission_info
+
+        self._update(f"submission_info/{team_id}.json", select)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS teams (
+    team_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS user_team (user_id TEXT PRIMARY KEY, team_id TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS submissions (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    submission_id TEXT NOT NULL UNIQUE,
+    team_id TEXT NOT NULL,
+    datetime TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_submissions (
+    team_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (team_id, date)
+);
+CREATE INDEX IF NOT EXISTS submissions_team_id ON submissions (team_id, datetime);
+CREATE INDEX IF NOT EXISTS submissions_status ON submissions (status);
+CREATE INDEX IF NOT EXISTS submissions_datetime ON submissions (datetime);
+"""
+
+
+class _HubMirror:
+    """Copies the files of the competition repo that changed in the database to the repo, in the background."""
+
+    def __init__(self, store, interval):
+        self.store = store
+        self.interval = interval
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="state-mirror", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def mark_dirty(self, *paths):
+        with self._lock:
+            self._dirty.update(paths)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                paths, self._dirty = self._dirty, set()
+            if not paths:
+                return
+            # the database is the source of truth, the files are replaced with its content at every commit attempt
+            updates = {path: [self._render_mutation(path)] for path in paths}
+            try:
+                hub.commit_json_updates(self.store.competition_id, updates, self.store.token)
+            except Exception as e:
+                logger.error(f"Failed to mirror {len(paths)} files to {self.store.competition_id}: {e}")
+                self.mark_dirty(*paths)
+
+    def _render_mutation(self, path):
+        return lambda _: self.store.render(path)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+
+class SQLiteStateStore(StateStore):
+    """
+    State in a local SQLite database in WAL mode, mirrored asynchronously to the json files of the competition repo.
+
+    The database is created from the repo the first time it is opened. Every process writing to the state has to
+    use the same database, e.g. the app and its local evaluation processes.
+    """
+
+    def __init__(self, competition_id, token, path=None, mirror_interval=STATE_MIRROR_INTERVAL):
+        self.competition_id = competition_id
+        self.token = token
+        self.path = path or os.path.join(STATE_DB_DIR, f"{competition_id.replace('/', '--')}.db")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+        self._import_from_hub()
+        self._mirror = _HubMirror(self, mirror_interval)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, func, *dirty_paths):
+        """Run `func(conn)` in a write transaction that bumps the state version, and mirror `dirty_paths`."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn)
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('version', '1') "
+                "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._mirror.mark_dirty(*dirty_paths)
+        return result
+
+    def _import_from_hub(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone():
+                conn.execute("ROLLBACK")
+                return
+            logger.info(f"Importing the state of {self.competition_id} into {self.path}")
+            hub_store = HubStateStore(self.competition_id, self.token)
+            user_team = hub.download_json(self.competition_id, "user_team.json", self.token)
+            conn.executemany("INSERT OR REPLACE INTO user_team VALUES (?, ?)", user_team.items())
+            for team_id, team in hub_store.get_teams().items():
+                conn.execute("INSERT OR REPLACE INTO teams (team_id, data) VALUES (?, ?)", (team_id, json.dumps(team)))
+            submission_jsons = hub.snapshot(self.competition_id, self.token, allow_patterns="submission_info/*.json")
+            for _json in glob.glob(os.path.join(submission_jsons, "submission_info/*.json")):
+                with open(_json, "r", encoding="utf-8") as f:
+                    team_submission_info = json.load(f)
+                for sub in team_submission_info["submissions"]:
+                    self._insert_submission(conn, team_submission_info["id"], sub)
+            conn.execute(
+                "INSERT INTO daily_submissions SELECT team_id, substr(datetime, 1, 10), COUNT(*) FROM submissions "
+                "GROUP BY team_id, substr(datetime, 1, 10)"
+            )
+            conn.execute("INSERT INTO meta (key, value) VALUES ('imported', '1'), ('version', '1')")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _insert_submission(conn, team_id, sub):
+        conn.execute(
+            "INSERT OR REPLACE INTO submissions (submission_id, team_id, datetime, status, data) VALUES (?, ?, ?, ?, ?)",
+            (sub["submission_id"], team_id, sub["datetime"], sub["status"], json.dumps(sub)),
+        )
+
+    @staticmethod
+    def _update_submission_row(conn, sub):
+        conn.execute(
+            "UPDATE submissions SET datetime = ?, status = ?, data = ? WHERE submission_id = ?",
+            (sub["datetime"], sub["status"], json.dumps(sub), sub["submission_id"]),
+        )
+
+    @staticmethod
+    def _touch_team(conn, team_id):
+        conn.execute("UPDATE teams SET version = version + 1 WHERE team_id = ?", (team_id,))
+
+    def render(self, path_in_repo):
+        """Content of a json file of the competition repo."""
+        if path_in_repo == "user_team.json":
+            return dict(self._conn().execute("SELECT user_id, team_id FROM user_team").fetchall())
+        if path_in_repo == "teams.json":
+            return self.get_teams()
+        team_id = os.path.basename(path_in_repo)[: -len(".json")]
+        return self.get_team_submissions(team_id)
+
+    def version(self):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return f"sqlite-{row[0] if row else 0}"
+
+    def team_versions(self, revision=None):
+        return {
+            team_id: str(version) for team_id, version in self._conn().execute("SELECT team_id, version FROM teams")
+        }
+
+    def get_user_team(self, user_id):
+        row = self._conn().execute("SELECT team_id FROM user_team WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def get_teams(self, revision=None):
+        return {team_id: json.loads(data) for team_id, data in self._conn().execute("SELECT team_id, data FROM teams")}
+
+    def get_team_submissions(self, team_id, revision=None):
+        rows = self._conn().execute("SELECT data FROM submissions WHERE team_id = ? ORDER BY seq", (team_id,))
+        return {"id": team_id, "submissions": [json.loads(data) for (data,) in rows]}
+
+    def pending_submissions(self):
+        rows = self._conn().execute(
+            "SELECT team_id, data FROM submissions WHERE status = ? ORDER BY datetime",
+            (SubmissionStatus.PENDING.value,),
+        )
+        return [dict(json.loads(data), team_id=team_id) for team_id, data in rows]
+
+    def create_team(self, team_id, user_id, user_name):
+        team = {"id": team_id, "name": user_name, "members": [user_id], "leader": user_id}
+
+        def create(conn):
+            # a concurrent request of the same user may have created its team first
+            conn.execute("INSERT OR IGNORE INTO user_team VALUES (?, ?)", (user_id, team_id))
+            (user_team_id,) = conn.execute("SELECT team_id FROM user_team WHERE user_id = ?", (user_id,)).fetchone()
+            if user_team_id == team_id:
+                conn.execute("INSERT INTO teams (team_id, data) VALUES (?, ?)", (team_id, json.dumps(team)))
+            return user_team_id
+
+        return self._write(create, "user_team.json", "teams.json", f"submission_info/{team_id}.json")
+
+    def rename_team(self, team_id, team_name):
+        def rename(conn):
+            (data,) = conn.execute("SELECT data FROM teams WHERE team_id = ?", (team_id,)).fetchone()
+            team = json.loads(data)
+            team["name"] = team_name
+            conn.execute("UPDATE teams SET data = ? WHERE team_id = ?", (json.dumps(team), team_id))
+
+        self._write(rename, "teams.json")
+
+    def add_submission(self, team_id, submission, submission_limit=None):
+        def add(conn):
+            key = (team_id, _submission_date(submission))
+            row = conn.execute("SELECT count FROM daily_submissions WHERE team_id = ? AND date = ?", key).fetchone()
+            if submission_limit is not None and row is not None and row[0] >= submission_limit:
+                raise SubmissionLimitError("Submission limit reached")
+            self._insert_submission(conn, team_id, submission)
+            self._touch_team(conn, team_id)
+            conn.execute(
+                "INSERT INTO daily_submissions VALUES (?, ?, 1) "
+                "ON CONFLICT (team_id, date) DO UPDATE SET count = count + 1",
+                key,
+            )
+            return conn.execute("SELECT count FROM daily_submissions WHERE team_id = ? AND date = ?", key).fetchone()[
+                0
+            ]
+
+        return self._write(add, f"submission_info/{team_id}.json")
+
+    def update_submission(self, team_id, submission_id, **fields):
+        def update(conn):
+            row = conn.execute(
+                "SELECT data FROM submissions WHERE submission_id = ? AND team_id = ?", (submission_id, team_id)
+            ).fetchone()
+            if row is None:
+                return
+            sub = json.loads(row[0])
+            sub.update(fields)
+            self._update_submission_row(conn, sub)
+            self._touch_team(conn, team_id)
+
+        self._write(update, f"submission_info/{team_id}.json")
+
+    def select_submissions(self, team_id, submission_ids):
+        def select(conn):
+            rows = conn.execute("SELECT data FROM submissions WHERE team_id = ?", (team_id,)).fetchall()
+            for (data,) in rows:
+                sub = json.loads(data)
+                sub["selected"] = sub["submission_id"] in submission_ids
+                self._update_submission_row(conn, sub)
+            self._touch_team(conn, team_id)
+
+        self._write(select, f"submission_info/{team_id}.json")
+
+
+_STATE_STORES = {}
+_STATE_STORES_LOCK = threading.Lock()
+
+
+def check_state_backend(competition_type):
+    """Raise if `STATE_BACKEND` cannot keep the state of a competition of `competition_type`."""
+    if competition_type == "script" and STATE_BACKEND != "hub":
+        # evaluation spaces write their results to the json files of the competition repo, which a local database
+        # would never read back and would overwrite with its own copy
+        raise ValueError(f"Script competitions need STATE_BACKEND=hub, not {STATE_BACKEND}")
+
+
+def get_state_store(competition_id, token):
+    """Return the state store of a competition, one per process, of the backend selected with `STATE_BACKEND`."""
+    key = (competition_id, token)
+    with _STATE_STORES_LOCK:
+        if key not in _STATE_STORES:
+            if STATE_BACKEND == "sqlite":
+                _STATE_STORES[key] = SQLiteStateStore(competition_id, token)
+            elif STATE_BACKEND == "hub":
+                _STATE_STORES[key] = HubStateStore(competition_id, token)
+            else:
+                raise ValueError(f"Unknown STATE_BACKEND {STATE_BACKEND}, expected hub or sqlite")
+        return _STATE_STORES[key]
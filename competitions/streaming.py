@@ -0,0 +1,168 @@
+import os
+
+import numpy as np
+
+from competitions.solution import IdCoverage
+
+
+STREAMING_MIN_ROWS = int(os.environ.get("STREAMING_MIN_ROWS", 1_000_000))
+STREAMING_CHUNK_SIZE = int(os.environ.get("STREAMING_CHUNK_SIZE", 100_000))
+
+
+class _MeanErrorAccumulator:
+    def __init__(self, error):
+        self.error = error
+        self.total = 0.0
+        self.count = 0
+
+    def update(self, y_true, y_pred):
+        self.total += float(np.sum(self.error(y_true - y_pred)))
+        self.count += len(y_true)
+
+    def result(self):
+        return self.total / self.count
+
+
+class _R2Accumulator:
+    # the sum of squares of the targets is merged chunk by chunk around their running mean (Chan et al.), the
+    # difference of raw sums cancels out for targets far from zero
+    def __init__(self):
+        self.sum_squared_error = 0.0
+        self.mean_true = 0.0
+        self.total_sum_of_squares = 0.0
+        self.count = 0
+
+    def update(self, y_true, y_pred):
+        if len(y_true) == 0:
+            return
+        self.sum_squared_error += float(np.sum((y_true - y_pred) ** 2))
+        chunk_mean = float(np.mean(y_true))
+        chunk_sum_of_squares = float(np.sum((y_true - chunk_mean) ** 2))
+        count = self.count + len(y_true)
+        delta = chunk_mean - self.mean_true
+        self.mean_true += delta * len(y_true) / count
+        self.total_sum_of_squares += chunk_sum_of_squares + delta**2 * self.count * len(y_true) / count
+        self.count = count
+
+    def result(self):
+        if self.total_sum_of_squares == 0:
+            # same convention as sklearn for a constant target
+            return 1.0 if self.sum_squared_error == 0 else 0.0
+        return 1 - self.sum_squared_error / self.total_sum_of_squares
+
+
+class _AccuracyAccumulator:
+    def __init__(self):
+        self.correct = 0
+        self.count = 0
+
+    def update(self, y_true, y_pred):
+        self.correct += int(np.sum(y_true == y_pred))
+        self.count += len(y_true)
+
+    def result(self):
+        return self.correct / self.count
+
+
+class _F1Accumulator:
+    # binary f1 of the positive label 1, like sklearn's default
+    def __init__(self):
+        self.true_positives = 0
+        self.false_positives = 0
+        self.false_negatives = 0
+
+    def update(self, y_true, y_pred):
+        if not (np.isin(y_true, (0, 1)).all() and np.isin(y_pred, (0, 1)).all()):
+            raise ValueError("Streaming f1_score only supports binary 0/1 labels")
+        self.true_positives += int(np.sum((y_true == 1) & (y_pred == 1)))
+        self.false_positives += int(np.sum((y_true == 0) & (y_pred == 1)))
+        self.false_negatives += int(np.sum((y_true == 1) & (y_pred == 0)))
+
+    def result(self):
+        denominator = 2 * self.true_positives + self.false_positives + self.false_negatives
+        return 2 * self.true_positives / denominator if denominator else 0.0
+
+
+class _RocAucAccumulator:
+    # every chunk is sorted by score on arrival, the sorted runs are merged once at the end
+    def __init__(self):
+        self.scores = []
+        self.labels = []
+
+    def update(self, y_true, y_pred):
+        order = np.argsort(y_pred, kind="stable")
+        self.scores.append(y_pred[order])
+        self.labels.append(y_true[order])
+
+    def result(self):
+        scores = np.concatenate(self.scores)
+        labels = np.concatenate(self.labels)
+        # a stable sort over concatenated sorted runs is a merge
+        order = np.argsort(scores, kind="stable")
+        scores = scores[order]
+        positives = labels[order] == 1
+
+        num_positives = int(positives.sum())
+        num_negatives = len(positives) - num_positives
+        if num_positives == 0 or num_negatives == 0:
+            raise ValueError("Only one class present in y_true. ROC AUC score is not defined in that case.")
+
+        # mann-whitney u statistic with average ranks for tied scores
+        group_starts = np.flatnonzero(np.r_[True, scores[1:] != scores[:-1]])
+        group_sizes = np.diff(np.r_[group_starts, len(scores)])
+        group_ranks = group_starts + (group_sizes + 1) / 2
+        ranks = np.repeat(group_ranks, group_sizes)
+        rank_sum = ranks[positives].sum()
+        return (rank_sum - num_positives * (num_positives + 1) / 2) / (num_positives * num_negatives)
+
+
+STREAMING_METRICS = {
+    "accuracy_score": _AccuracyAccumulator,
+    "f1_score": _F1Accumulator,
+    "mean_squared_error": lambda: _MeanErrorAccumulator(np.square),
+    "mean_absolute_error": lambda: _MeanErrorAccumulator(np.abs),
+    "r2_score": _R2Accumulator,
+    "roc_auc_score": _RocAucAccumulator,
+}
+
+
+# the accumulators of these metrics take 1 as the positive label, sklearn takes the larger of the two labels
+BINARY_METRICS = ("f1_score", "roc_auc_score")
+
+
+def _has_binary_labels(solution):
+    targets = solution.row_targets[solution.row_splits >= 0]
+    return bool(np.isin(targets, (0, 1)).all())
+
+
+def supports_streaming(params, solution):
+    return (
+        params.metric in STREAMING_METRICS
+        and len(solution.target_cols) == 1
+        and int(params.submission_rows) >= STREAMING_MIN_ROWS
+        and (params.metric not in BINARY_METRICS or _has_binary_labels(solution))
+    )
+
+
+def score_streaming(submission_chunks, solution, metric):
+    """
+    Score a submission read in chunks, keeping memory bounded by the chunk size and the solution.
+
+    Every chunk is aligned to the solution with the same rules as `Solution.align` and fed to one accumulator per
+    split. Returns the public and private scores.
+    """
+    accumulators = [STREAMING_METRICS[metric](), STREAMING_METRICS[metric]()]
+    row_splits = solution.row_splits
+    row_targets = solution.row_targets
+    coverage = IdCoverage(solution.index)
+
+    for chunk in submission_chunks:
+        positions, found = coverage.update(chunk[solution.id_col].to_numpy())
+        y_pred = chunk[solution.target_cols[0]].to_numpy()[found]
+        y_true = row_targets[positions]
+        for split, accumulator in enumerate(accumulators):
+            in_split = row_splits[positions] == split
+            accumulator.update(y_true[in_split], y_pred[in_split])
+
+    coverage.check()
+    return accumulators[0].result(), accumulators[1].result()
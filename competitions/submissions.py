@@ -1,15 +1,20 @@
-import io
 import json
 import uuid
 from dataclasses import dataclass
 from datetime import datetime
+from typing import List, Optional
 
 import pandas as pd
-from huggingface_hub import HfApi, hf_hub_download
 
+from competitions import hub
 from competitions.enums import SubmissionStatus
-from competitions.errors import AuthenticationError, PastDeadlineError, SubmissionError, SubmissionLimitError
+from competitions.errors import AuthenticationError, PastDeadlineError, SubmissionError
+from competitions.formats import submission_format
+from competitions.job_queue import PENDING_SUBMISSIONS, PendingSubmission
+from competitions.solution import get_solution
+from competitions.state import get_state_store
 from competitions.utils import token_information
+from competitions.validation import validate_submission
 
 
 @dataclass
@@ -20,33 +25,25 @@ class Submissions:
     hardware: str
     end_date: datetime
     token: str
-
-    def _verify_submission(self, bytes_data):
+    submission_cols: Optional[List[str]] = None
+    submission_rows: Optional[int] = None
+    submission_id_col: Optional[str] = None
+    metric: Optional[str] = None
+
+    def _verify_submission(self, bytes_data, fmt):
+        if fmt is None or not self.submission_cols:
+            return True
+        # ids and scores can only be checked for built-in metrics, a custom metric reads the solution its own way
+        solution = None
+        if self.metric is not None and self.metric != "custom":
+            solution = get_solution(self.competition_id, self.submission_id_col, self.token)
+        submission_rows = int(self.submission_rows) if self.submission_rows is not None else None
+        validate_submission(bytes_data, fmt, self.submission_cols, submission_rows, solution)
         return True
 
-    def _num_subs_today(self, todays_date, team_submission_info):
-        todays_submissions = 0
-        for sub in team_submission_info["submissions"]:
-            submission_datetime = sub["datetime"]
-            submission_date = submission_datetime.split(" ")[0]
-            if submission_date == todays_date:
-                todays_submissions += 1
-        return todays_submissions
-
-    def _is_submission_allowed(self, team_id):
-        todays_date = datetime.now()
-        if todays_date > self.end_date:
+    def _is_submission_allowed(self):
+        if datetime.now() > self.end_date:
             raise PastDeadlineError("Competition has ended.")
-
-        todays_date = todays_date.strftime("%Y-%m-%d")
-        team_submission_info = self._download_team_submissions(team_id)
-
-        if len(team_submission_info["submissions"]) == 0:
-            team_submission_info["submissions"] = []
-
-        todays_submissions = self._num_subs_today(todays_date, team_submission_info)
-        if todays_submissions >= self.submission_limit:
-            return False
         return True
 
     def _increment_submissions(
@@ -62,59 +59,39 @@ class Submissions:
             submission_repo = ""
         if space_id is None:
             space_id = ""
-        team_fname = hf_hub_download(
-            repo_id=self.competition_id,
-            filename=f"submission_info/{team_id}.json",
-            token=self.token,
-            repo_type="dataset",
-        )
-        with open(team_fname, "r", encoding="utf-8") as f:
-            team_submission_info = json.load(f)
         datetime_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
         # here goes all the default stuff for submission
-        team_submission_info["submissions"].append(
-            {
-                "datetime": datetime_now,
-                "submission_id": submission_id,
-                "submission_comment": submission_comment,
-                "submission_repo": submission_repo,
-                "space_id": space_id,
-                "submitted_by": user_id,
-                "status": SubmissionStatus.PENDING.value,
-                "selected": False,
-                "public_score": {},
-                "private_score": {},
-            }
-        )
-        # count the number of times user has submitted today
-        todays_date = datetime.now().strftime("%Y-%m-%d")
-        todays_submissions = self._num_subs_today(todays_date, team_submission_info)
-        self._upload_team_submissions(team_id, team_submission_info)
-        return todays_submissions
-
-    def _upload_team_submissions(self, team_id, team_submission_info):
-        team_submission_info_json = json.dumps(team_submission_info, indent=4)
-        team_submission_info_json_bytes = team_submission_info_json.encode("utf-8")
-        team_submission_info_json_buffer = io.BytesIO(team_submission_info_json_bytes)
-        api = HfApi(token=self.token)
-        api.upload_file(
-            path_or_fileobj=team_submission_info_json_buffer,
-            path_in_repo=f"submission_info/{team_id}.json",
-            repo_id=self.competition_id,
-            repo_type="dataset",
+        submission = {
+            "datetime": datetime_now,
+            "submission_id": submission_id,
+            "submission_comment": submission_comment,
+            "submission_repo": submission_repo,
+            "space_id": space_id,
+            "submitted_by": user_id,
+            "status": SubmissionStatus.PENDING.value,
+            "selected": False,
+            "public_score": {},
+            "private_score": {},
+        }
+
+        # count the number of times user has submitted today, raises if the team has reached the limit
+        todays_submissions = self._state.add_submission(team_id, submission, self.submission_limit)
+        pending_submission = PendingSubmission(
+            datetime=datetime_now,
+            team_id=team_id,
+            submission_id=submission_id,
+            submission_repo=submission_repo,
+            space_id=space_id,
         )
+        return todays_submissions, pending_submission
+
+    @property
+    def _state(self):
+        return get_state_store(self.competition_id, self.token)
 
     def _download_team_submissions(self, team_id):
-        team_fname = hf_hub_download(
-            repo_id=self.competition_id,
-            filename=f"submission_info/{team_id}.json",
-            token=self.token,
-            repo_type="dataset",
-        )
-        with open(team_fname, "r", encoding="utf-8") as f:
-            team_submission_info = json.load(f)
-        return team_submission_info
+        return self._state.get_team_submissions(team_id)
 
     def update_selected_submissions(self, user_token, selected_submission_ids):
         current_datetime = datetime.now()
@@ -123,15 +100,8 @@ class Submissions:
 
         user_info = self._get_user_info(user_token)
         team_id = self._get_team_id(user_info, create_team=False)
-        team_submission_info = self._download_team_submissions(team_id)
-
-        for sub in team_submission_info["submissions"]:
-            if sub["submission_id"] in selected_submission_ids:
-                sub["selected"] = True
-            else:
-                sub["selected"] = False
 
-        self._upload_team_submissions(team_id, team_submission_info)
+        self._state.select_submissions(team_id, selected_submission_ids)
 
     def _get_team_subs(self, team_id, private=False):
         team_submissions_info = self._download_team_submissions(team_id)
@@ -176,84 +146,24 @@ class Submissions:
             return pd.DataFrame()
         return self._get_team_subs(team_id, private=private)
 
-    def _create_team(self, user_team, user_id, user_name):
-        team_metadata = hf_hub_download(
-            repo_id=self.competition_id,
-            filename="teams.json",
-            token=self.token,
-            repo_type="dataset",
-        )
-
-        with open(team_metadata, "r", encoding="utf-8") as f:
-            team_metadata = json.load(f)
-
+    def _create_team(self, user_id, user_name):
         # create a new team, if user is not in any team
         team_id = str(uuid.uuid4())
-        user_team[user_id] = team_id
-
-        team_metadata[team_id] = {
-            "id": team_id,
-            "name": user_name,
-            "members": [user_id],
-            "leader": user_id,
-        }
-
-        user_team_json = json.dumps(user_team, indent=4)
-        user_team_json_bytes = user_team_json.encode("utf-8")
-        user_team_json_buffer = io.BytesIO(user_team_json_bytes)
-
-        team_metadata_json = json.dumps(team_metadata, indent=4)
-        team_metadata_json_bytes = team_metadata_json.encode("utf-8")
-        team_metadata_json_buffer = io.BytesIO(team_metadata_json_bytes)
-
-        team_submission_info = {}
-        team_submission_info["id"] = team_id
-        team_submission_info["submissions"] = []
-        team_submission_info_json = json.dumps(team_submission_info, indent=4)
-        team_submission_info_json_bytes = team_submission_info_json.encode("utf-8")
-        team_submission_info_json_buffer = io.BytesIO(team_submission_info_json_bytes)
-
-        api = HfApi(token=self.token)
-        api.upload_file(
-            path_or_fileobj=user_team_json_buffer,
-            path_in_repo="user_team.json",
-            repo_id=self.competition_id,
-            repo_type="dataset",
-        )
-        api.upload_file(
-            path_or_fileobj=team_metadata_json_buffer,
-            path_in_repo="teams.json",
-            repo_id=self.competition_id,
-            repo_type="dataset",
-        )
-        api.upload_file(
-            path_or_fileobj=team_submission_info_json_buffer,
-            path_in_repo=f"submission_info/{team_id}.json",
-            repo_id=self.competition_id,
-            repo_type="dataset",
-        )
-        return team_id
+        return self._state.create_team(team_id, user_id, user_name)
 
     def _get_team_id(self, user_info, create_team):
         user_id = user_info["id"]
         user_name = user_info["name"]
-        user_team = hf_hub_download(
-            repo_id=self.competition_id,
-            filename="user_team.json",
-            token=self.token,
-            repo_type="dataset",
-        )
-        with open(user_team, "r", encoding="utf-8") as f:
-            user_team = json.load(f)
+        team_id = self._state.get_user_team(user_id)
 
-        if user_id in user_team:
-            return user_team[user_id]
+        if team_id is not None:
+            return team_id
 
         if create_team is False:
             return None
 
         # if user_id is not there in user_team, create a new team
-        team_id = self._create_team(user_team, user_id, user_name)
+        team_id = self._create_team(user_id, user_name)
         return team_id
 
     def new_submission(self, user_token, uploaded_file, submission_comment):
@@ -261,33 +171,37 @@ class Submissions:
         user_info = self._get_user_info(user_token)
         submission_id = str(uuid.uuid4())
         user_id = user_info["id"]
-        team_id = self._get_team_id(user_info, create_team=True)
-
-        # check if team can submit to the competition
-        if self._is_submission_allowed(team_id) is False:
-            raise SubmissionLimitError("Submission limit reached")
 
         if self.competition_type == "generic":
             bytes_data = uploaded_file.file.read()
-            # verify file is valid
-            if not self._verify_submission(bytes_data):
+            fmt = submission_format(uploaded_file.filename)
+            # verify file is valid, before anything is written to the hub
+            if not self._verify_submission(bytes_data, fmt):
                 raise SubmissionError("Invalid submission file")
 
+        team_id = self._get_team_id(user_info, create_team=True)
+
+        # check if the competition is still open, the submission limit is checked when the submission is added
+        self._is_submission_allowed()
+
+        if self.competition_type == "generic":
             file_extension = uploaded_file.filename.split(".")[-1]
-            # upload file to hf hub
-            api = HfApi(token=self.token)
-            api.upload_file(
-                path_or_fileobj=bytes_data,
-                path_in_repo=f"submissions/{team_id}-{submission_id}.{file_extension}",
-                repo_id=self.competition_id,
-                repo_type="dataset",
-            )
-            submissions_made = self._increment_submissions(
+            if fmt is not None:
+                # tabular submissions are stored under a lower case extension so that the evaluation can find them
+                file_extension = file_extension.lower()
+            submissions_made, pending_submission = self._increment_submissions(
                 team_id=team_id,
                 user_id=user_id,
                 submission_id=submission_id,
                 submission_comment=submission_comment,
             )
+            # the file is committed with the submission info, a commit per file would conflict with the batched ones
+            hub.upload_batched(
+                self.competition_id,
+                f"submissions/{team_id}-{submission_id}.{file_extension}",
+                bytes_data,
+                self.token,
+            )
         else:
             # Download the submission repo and upload it to the competition repo
             # submission_repo = snapshot_download(
@@ -309,12 +223,20 @@ class Submissions:
             #     repo_type="model",
             # )
             # create barebones submission runner space
-            user_api = HfApi(token=user_token)
+            user_api = hub.get_api(user_token)
             # submission_id is the sha of the submitted model repo + "__" + submission_id
             submission_id = user_api.model_info(repo_id=uploaded_file).sha + "__" + submission_id
             competition_organizer = self.competition_id.split("/")[0]
             space_id = f"{competition_organizer}/comp-{submission_id}"
-            api = HfApi(token=self.token)
+            submissions_made, pending_submission = self._increment_submissions(
+                team_id=team_id,
+                user_id=user_id,
+                submission_id=submission_id,
+                submission_comment=submission_comment,
+                submission_repo=uploaded_file,
+                space_id=space_id,
+            )
+            api = hub.get_api(self.token)
             api.create_repo(
                 repo_id=space_id,
                 repo_type="space",
@@ -324,13 +246,8 @@ class Submissions:
             )
 
             api.add_space_secret(repo_id=space_id, key="USER_TOKEN", value=user_token)
-            submissions_made = self._increment_submissions(
-                team_id=team_id,
-                user_id=user_id,
-                submission_id=submission_id,
-                submission_comment=submission_comment,
-                submission_repo=uploaded_file,
-                space_id=space_id,
-            )
+
+        # hand the submission over to the job runner of this process, once its file or space exists
+        PENDING_SUBMISSIONS.put(pending_submission)
         remaining_submissions = self.submission_limit - submissions_made
         return remaining_submissions
@@ -0,0 +1,101 @@
+import json
+
+import pytest
+from huggingface_hub.utils import HfHubHTTPError
+
+from competitions import hub
+
+
+REPO_ID = "org/competition"
+TOKEN = "hf_token"
+
+
+@pytest.fixture
+def local_repo(tmp_path, monkeypatch):
+    monkeypatch.setattr(hub, "HUB_LOCAL_DIR", str(tmp_path))
+    monkeypatch.setattr(hub, "HUB_COMMIT_BACKOFF", 0)
+    repo_dir = tmp_path / "datasets" / REPO_ID
+    repo_dir.mkdir(parents=True)
+    (repo_dir / "counter.json").write_text(json.dumps({"count": 0}))
+    return repo_dir
+
+
+def _increment(data):
+    return {"count": data["count"] + 1}
+
+
+def test_commit_json_updates_retries_on_conflict(local_repo):
+    seen = []
+
+    def increment(data):
+        seen.append(data["count"])
+        if len(seen) == 1:
+            # another writer commits between the read and the commit of this one
+            hub.upload(REPO_ID, "counter.json", json.dumps({"count": 10}).encode(), TOKEN)
+        return _increment(data)
+
+    results = hub.commit_json_updates(
+        REPO_ID, {"counter.json": [increment]}, TOKEN, files={"submissions/team-1.csv": b"id,target\n"}
+    )
+
+    assert seen == [0, 10]
+    assert results == {"counter.json": {"count": 11}}
+    assert hub.download_json(REPO_ID, "counter.json", TOKEN) == {"count": 11}
+    assert hub.paths_info(REPO_ID, ["submissions/team-1.csv"], TOKEN)
+
+
+def test_commit_json_updates_gives_up_after_retries(local_repo, monkeypatch):
+    monkeypatch.setattr(hub, "HUB_COMMIT_RETRIES", 2)
+    calls = []
+
+    def conflicting(data):
+        calls.append(data["count"])
+        hub.upload(REPO_ID, "other.json", json.dumps(len(calls)).encode(), TOKEN)
+        return _increment(data)
+
+    with pytest.raises(HfHubHTTPError) as excinfo:
+        hub.commit_json_updates(REPO_ID, {"counter.json": [conflicting]}, TOKEN)
+    assert excinfo.value.response.status_code == 412
+    assert len(calls) == 3
+    assert hub.download_json(REPO_ID, "counter.json", TOKEN) == {"count": 0}
+
+
+def test_commit_batcher_reads_its_own_writes(local_repo):
+    batcher = hub.CommitBatcher(interval=3600, max_operations=100)
+    assert batcher.stage(REPO_ID, "counter.json", _increment, TOKEN) == {"count": 1}
+    assert batcher.stage(REPO_ID, "counter.json", _increment, TOKEN) == {"count": 2}
+    assert batcher.read(REPO_ID, "counter.json") == {"count": 2}
+    assert hub.download_json(REPO_ID, "counter.json", TOKEN) == {"count": 0}
+
+    batcher.flush(raise_errors=True)
+    assert batcher.read(REPO_ID, "counter.json") is None
+    assert hub.download_json(REPO_ID, "counter.json", TOKEN) == {"count": 2}
+
+
+def test_commit_batcher_keeps_failed_updates_staged(local_repo, monkeypatch):
+    batcher = hub.CommitBatcher(interval=3600, max_operations=100)
+    commit_json_updates = hub.commit_json_updates
+
+    def failing_commit(*args, **kwargs):
+        raise HfHubHTTPError("hub is down")
+
+    monkeypatch.setattr(hub, "commit_json_updates", failing_commit)
+    batcher.stage(REPO_ID, "counter.json", _increment, TOKEN)
+    with pytest.raises(HfHubHTTPError):
+        batcher.flush(raise_errors=True)
+    assert batcher.read(REPO_ID, "counter.json") == {"count": 1}
+
+    def commit_with_concurrent_stage(*args, **kwargs):
+        # staged while the commit is in flight, it is left for the next flush
+        batcher.stage(REPO_ID, "counter.json", _increment, TOKEN)
+        return commit_json_updates(*args, **kwargs)
+
+    monkeypatch.setattr(hub, "commit_json_updates", commit_with_concurrent_stage)
+    batcher.flush(raise_errors=True)
+    assert hub.download_json(REPO_ID, "counter.json", TOKEN) == {"count": 1}
+    assert batcher.read(REPO_ID, "counter.json") == {"count": 2}
+
+    monkeypatch.setattr(hub, "commit_json_updates", commit_json_updates)
+    batcher.flush(raise_errors=True)
+    assert hub.download_json(REPO_ID, "counter.json", TOKEN) == {"count": 2}
+    assert batcher.read(REPO_ID, "counter.json") is None
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from competitions.ranking import best_per_team, select_private_submissions
+
+
+def _submissions(seed, num_teams=40):
+    """Submissions of random teams in random order, scores are drawn from a few values to get ties."""
+    rng = np.random.default_rng(seed)
+    team_idx, datetime = [], []
+    for team in range(num_teams):
+        num_submissions = rng.integers(1, 7)
+        team_idx.extend([team] * num_submissions)
+        datetime.extend(np.sort(rng.choice(1000, num_submissions, replace=False)))
+    order = rng.permutation(len(team_idx))
+    return {
+        "team_idx": np.array(team_idx)[order],
+        "datetime": np.array(datetime, dtype=np.int64)[order],
+        "public": rng.integers(0, 4, len(order)).astype(float),
+        "private": rng.integers(0, 4, len(order)).astype(float),
+        "selected": rng.random(len(order)) < 0.3,
+    }
+
+
+def _team_rows(subs, team):
+    # the submissions of a team in the order of its submission_info file, i.e. by datetime
+    rows = np.flatnonzero(subs["team_idx"] == team)
+    return list(rows[np.argsort(subs["datetime"][rows], kind="stable")])
+
+
+def _best(rows, scores, higher_is_better):
+    # sort of the baseline leaderboard: a stable sort on the score alone, the first submission wins ties
+    return sorted(rows, key=lambda row: scores[row], reverse=higher_is_better)[0]
+
+
+def _baseline_public(subs, higher_is_better):
+    teams = np.unique(subs["team_idx"])
+    return sorted(_best(_team_rows(subs, team), subs["public"], higher_is_better) for team in teams)
+
+
+def _baseline_private(subs, max_selected_submissions, higher_is_better):
+    best_rows, skipped_teams = [], []
+    for team in np.unique(subs["team_idx"]):
+        rows = _team_rows(subs, team)
+        selected_rows = [row for row in rows if subs["selected"][row]]
+        if len(selected_rows) == 0:
+            best_rows.append(_best(rows, subs["public"], higher_is_better))
+        elif len(selected_rows) <= max_selected_submissions:
+            best_rows.append(_best(selected_rows, subs["private"], higher_is_better))
+        else:
+            skipped_teams.append(team)
+    return sorted(best_rows), skipped_teams
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("higher_is_better", [True, False])
+def test_best_per_team_matches_baseline(seed, higher_is_better):
+    subs = _submissions(seed)
+    best_rows = best_per_team(subs["team_idx"], subs["public"], subs["datetime"], higher_is_better=higher_is_better)
+    assert sorted(best_rows) == _baseline_public(subs, higher_is_better)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("higher_is_better", [True, False])
+@pytest.mark.parametrize("max_selected_submissions", [1, 2])
+def test_select_private_submissions_matches_baseline(seed, higher_is_better, max_selected_submissions):
+    subs = _submissions(seed)
+    best_rows, skipped_teams = select_private_submissions(
+        subs["team_idx"],
+        subs["public"],
+        subs["private"],
+        subs["selected"],
+        subs["datetime"],
+        max_selected_submissions=max_selected_submissions,
+        higher_is_better=higher_is_better,
+    )
+    expected_rows, expected_skipped_teams = _baseline_private(subs, max_selected_submissions, higher_is_better)
+    assert list(best_rows) == expected_rows
+    assert list(skipped_teams) == expected_skipped_teams
+
+
+def test_ties_go_to_the_earliest_submission():
+    team_idx = np.array([0, 0, 0, 1, 1])
+    scores = np.array([0.5, 0.9, 0.9, 0.1, 0.1])
+    datetime = np.array([1, 30, 20, 5, 4])
+    assert list(best_per_team(team_idx, scores, datetime)) == [2, 4]
+    assert list(best_per_team(team_idx, scores, datetime, higher_is_better=False)) == [0, 4]
+
+
+def test_submissions_without_score_are_ignored():
+    team_idx = np.array([0, 0, 1])
+    scores = np.array([np.nan, 0.2, np.nan])
+    datetime = np.array([1, 2, 3])
+    assert list(best_per_team(team_idx, scores, datetime)) == [1]
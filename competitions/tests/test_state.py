@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from competitions import hub
+from competitions.errors import SubmissionLimitError
+from competitions.state import HubStateStore, SQLiteStateStore
+
+
+REPO_ID = "org/competition"
+TOKEN = "hf_token"
+TEAM_ID = "team-1"
+
+
+@pytest.fixture
+def local_repo(tmp_path, monkeypatch):
+    monkeypatch.setattr(hub, "HUB_LOCAL_DIR", str(tmp_path))
+    monkeypatch.setattr(hub, "HUB_COMMIT_BACKOFF", 0)
+    monkeypatch.setattr(hub, "_COMMIT_BATCHER", hub.CommitBatcher(interval=3600, max_operations=100))
+    repo_dir = tmp_path / "datasets" / REPO_ID
+    (repo_dir / "submission_info").mkdir(parents=True)
+    (repo_dir / "user_team.json").write_text(json.dumps({"user-1": TEAM_ID}))
+    (repo_dir / "teams.json").write_text(json.dumps({TEAM_ID: {"id": TEAM_ID, "name": "user-1"}}))
+    (repo_dir / "submission_info" / f"{TEAM_ID}.json").write_text(json.dumps({"id": TEAM_ID, "submissions": []}))
+    return repo_dir
+
+
+@pytest.fixture
+def store(local_repo):
+    return HubStateStore(REPO_ID, TOKEN)
+
+
+@pytest.fixture
+def sqlite_store(local_repo, tmp_path):
+    store = SQLiteStateStore(REPO_ID, TOKEN, path=str(tmp_path / "state.db"), mirror_interval=3600)
+    yield store
+    # mirror the writes while the local repo is still in place
+    store._mirror.flush()
+
+
+def _submission(submission_id, date="2024-01-01"):
+    return {"submission_id": submission_id, "datetime": f"{date} 10:00:00"}
+
+
+def test_submission_limit_counts_staged_submissions(store):
+    assert store.add_submission(TEAM_ID, _submission("s1"), submission_limit=2) == 1
+    assert store.add_submission(TEAM_ID, _submission("s2"), submission_limit=2) == 2
+    with pytest.raises(SubmissionLimitError):
+        store.add_submission(TEAM_ID, _submission("s3"), submission_limit=2)
+    assert store.add_submission(TEAM_ID, _submission("s4", date="2024-01-02"), submission_limit=2) == 1
+
+    hub.flush_commits()
+    submissions = store.get_team_submissions(TEAM_ID)["submissions"]
+    assert [sub["submission_id"] for sub in submissions] == ["s1", "s2", "s4"]
+
+
+def test_submission_limit_counts_submissions_of_other_writers(store):
+    store.add_submission(TEAM_ID, _submission("s1"), submission_limit=2)
+    hub.flush_commits()
+    # another replica adds a submission, the next one is checked against the file in the repo
+    other = {"id": TEAM_ID, "submissions": [_submission("s1"), _submission("s2")]}
+    hub.upload(REPO_ID, f"submission_info/{TEAM_ID}.json", json.dumps(other).encode(), TOKEN)
+    with pytest.raises(SubmissionLimitError):
+        store.add_submission(TEAM_ID, _submission("s3"), submission_limit=2)
+
+
+def test_sqlite_create_team_returns_the_existing_team(sqlite_store):
+    assert sqlite_store.create_team("team-2", "user-2", "user-2") == "team-2"
+    # a concurrent request of the same user that did not see the new team yet
+    assert sqlite_store.create_team("team-3", "user-2", "user-2") == "team-2"
+    assert sqlite_store.get_user_team("user-2") == "team-2"
+    assert sorted(sqlite_store.get_teams()) == [TEAM_ID, "team-2"]
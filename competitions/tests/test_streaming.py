@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn import metrics
+
+from competitions import streaming
+from competitions.errors import SubmissionValidationError
+from competitions.solution import MAX_REPORTED_EXTRA_IDS, IdCoverage, Solution
+from competitions.streaming import STREAMING_METRICS, supports_streaming
+
+
+def _labels(rng, num_rows):
+    return rng.integers(0, 2, num_rows)
+
+
+def _values(rng, num_rows):
+    return rng.normal(0, 1, num_rows)
+
+
+CASES = {
+    "accuracy_score": (_labels, _labels),
+    "f1_score": (_labels, _labels),
+    "roc_auc_score": (_labels, lambda rng, num_rows: rng.integers(0, 20, num_rows) / 20),
+    "mean_squared_error": (_values, _values),
+    "mean_absolute_error": (_values, _values),
+    "r2_score": (_values, _values),
+}
+
+
+def _score_in_chunks(metric, y_true, y_pred, chunk_size):
+    accumulator = STREAMING_METRICS[metric]()
+    for start in range(0, len(y_true), chunk_size):
+        accumulator.update(y_true[start : start + chunk_size], y_pred[start : start + chunk_size])
+    return accumulator.result()
+
+
+@pytest.mark.parametrize("metric", sorted(STREAMING_METRICS))
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000, 10_000])
+def test_accumulator_matches_sklearn(metric, chunk_size):
+    rng = np.random.default_rng(0)
+    true_fn, pred_fn = CASES[metric]
+    y_true, y_pred = true_fn(rng, 5000), pred_fn(rng, 5000)
+    expected = getattr(metrics, metric)(y_true, y_pred)
+    assert _score_in_chunks(metric, y_true, y_pred, chunk_size) == pytest.approx(expected, rel=1e-9)
+
+
+def test_r2_targets_far_from_zero():
+    rng = np.random.default_rng(0)
+    y_true = 1e9 + rng.normal(0, 1, 100_000)
+    y_pred = y_true + rng.normal(0, 0.5, 100_000)
+    expected = metrics.r2_score(y_true, y_pred)
+    assert _score_in_chunks("r2_score", y_true, y_pred, 1000) == pytest.approx(expected, rel=1e-6)
+
+
+def test_extra_ids_are_bounded():
+    coverage = IdCoverage(pd.Index(np.arange(10)))
+    for start in range(0, 10_000, 1000):
+        coverage.update(np.arange(start, start + 1000))
+    with pytest.raises(SubmissionValidationError) as excinfo:
+        coverage.check()
+    assert len(excinfo.value.extra_ids) == MAX_REPORTED_EXTRA_IDS
+    assert excinfo.value.num_extra_ids == 9990
+    assert str(excinfo.value).startswith("Invalid submission: 9990 extra ids (e.g. 10, 11")
+
+
+@pytest.mark.parametrize("metric", ["f1_score", "roc_auc_score"])
+def test_binary_metrics_stream_only_01_labels(metric, monkeypatch):
+    monkeypatch.setattr(streaming, "STREAMING_MIN_ROWS", 1)
+    params = SimpleNamespace(metric=metric, submission_rows=1000)
+    for labels, expected in (((0, 1), True), ((1, 2), False)):
+        solution_df = pd.DataFrame(
+            {
+                "id": np.arange(1000),
+                "target": np.resize(labels, 1000),
+                "split": np.resize(["public", "private"], 1000),
+            }
+        )
+        solution = Solution.from_dataframe(solution_df, "id")
+        assert supports_streaming(params, solution) is expected
@@ -1,25 +1,81 @@
-import io
+import copy
+import hashlib
 import json
 import os
 import shlex
 import subprocess
+import threading
+import time
 import traceback
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
 
 import requests
 from fastapi import Request
-from huggingface_hub import HfApi, hf_hub_download
 from loguru import logger
 
+from competitions import hub
 from competitions.enums import SubmissionStatus
+from competitions.errors import InvalidTokenError
+from competitions.instrumentation import WHOAMI_SECONDS, child_env
 from competitions.params import EvalParams
+from competitions.state import get_state_store
 
 from . import HF_URL
 
 
 USER_TOKEN = os.environ.get("USER_TOKEN")
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", 300))
+TOKEN_CACHE_NEGATIVE_TTL = float(os.environ.get("TOKEN_CACHE_NEGATIVE_TTL", 30))
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 4096))
+
+
+@dataclass
+class _CachedTokenInformation:
+    user_info: Optional[dict]
+    expires_at: float
+
+
+# resolved user info keyed by the sha256 of the token, None for tokens the hub rejected
+_TOKEN_CACHE = OrderedDict()
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+
+def _token_cache_key(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
 
 
 def token_information(token):
+    key = _token_cache_key(token)
+    now = time.time()
+    with _TOKEN_CACHE_LOCK:
+        cached = _TOKEN_CACHE.get(key)
+        if cached is not None and cached.expires_at > now:
+            _TOKEN_CACHE.move_to_end(key)
+            if cached.user_info is None:
+                raise Exception("Invalid token.")
+            return copy.deepcopy(cached.user_info)
+
+    try:
+        user_info = _request_token_information(token)
+    except InvalidTokenError:
+        user_info = None
+
+    # unreachable hub errors are raised above and never cached
+    ttl = TOKEN_CACHE_TTL if user_info is not None else TOKEN_CACHE_NEGATIVE_TTL
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE[key] = _CachedTokenInformation(user_info=user_info, expires_at=now + ttl)
+        _TOKEN_CACHE.move_to_end(key)
+        while len(_TOKEN_CACHE) > TOKEN_CACHE_SIZE:
+            _TOKEN_CACHE.popitem(last=False)
+
+    if user_info is None:
+        raise Exception("Invalid token.")
+    return copy.deepcopy(user_info)
+
+
+def _request_token_information(token):
     if token.startswith("hf_oauth"):
         _api_url = HF_URL + "/oauth/userinfo"
     else:
@@ -31,19 +87,24 @@ def token_information(token):
     else:
         cookies = {"token": token}
     try:
-        response = requests.get(
-            _api_url,
-            headers=headers,
-            cookies=cookies,
-            timeout=3,
-        )
+        with WHOAMI_SECONDS.timer():
+            response = hub.http_get(
+                _api_url,
+                headers=headers,
+                cookies=cookies,
+                timeout=3,
+            )
     except (requests.Timeout, ConnectionError) as err:
         logger.error(f"Failed to request whoami-v2 - {repr(err)}")
         raise Exception("Hugging Face Hub is unreachable, please try again later.")
 
+    if response.status_code in (401, 403):
+        logger.error(f"Failed to request whoami-v2 - {response.status_code}")
+        raise InvalidTokenError("Invalid token.")
     if response.status_code != 200:
+        # rate limits and server errors say nothing about the token
         logger.error(f"Failed to request whoami-v2 - {response.status_code}")
-        raise Exception("Invalid token.")
+        raise Exception("Hugging Face Hub is unreachable, please try again later.")
 
     resp = response.json()
     user_info = {}
@@ -106,12 +167,13 @@ def user_authentication_dep(token, return_raw=False):
     else:
         cookies = {"token": token}
     try:
-        response = requests.get(
-            _api_url,
-            headers=headers,
-            cookies=cookies,
-            timeout=3,
-        )
+        with WHOAMI_SECONDS.timer():
+            response = hub.http_get(
+                _api_url,
+                headers=headers,
+                cookies=cookies,
+                timeout=3,
+            )
     except (requests.Timeout, ConnectionError) as err:
         logger.error(f"Failed to request whoami-v2 - {repr(err)}")
         raise Exception("Hugging Face Hub is unreachable, please try again later.")
@@ -128,7 +190,6 @@ def user_authentication_dep(token, return_raw=False):
         user_info["name"] = resp["preferred_username"]
         user_info["orgs"] = [resp["orgs"][k]["preferred_username"] for k in range(len(resp["orgs"]))]
     else:
-
         user_info["id"] = resp["id"]
         user_info["name"] = resp["name"]
         user_info["orgs"] = [resp["orgs"][k]["name"] for k in range(len(resp["orgs"]))]
@@ -140,7 +201,7 @@ def make_clickable_user(user_id):
     return f'<a  target="_blank" href="{link}">{user_id}</a>'
 
 
-def run_evaluation(params, local=False, wait=False):
+def run_evaluation(params, local=False, wait=False, timeout=None):
     params = json.loads(params)
     if isinstance(params, str):
         params = json.loads(params)
@@ -158,74 +219,62 @@ def run_evaluation(params, local=False, wait=False):
 
     cmd = [str(c) for c in cmd]
     logger.info(cmd)
-    env = os.environ.copy()
+    env = child_env()
     cmd = shlex.split(" ".join(cmd))
     process = subprocess.Popen(cmd, env=env)
     if wait:
-        process.wait()
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logger.info(f"Evaluation exceeded {timeout} seconds time limit. Terminating...")
+            process.kill()
+            process.wait()
+            raise
     return process.pid
 
 
 def pause_space(params):
+    # staged submission updates have to be committed before the space goes away, the space is kept if they are not
+    hub.flush_commits()
     if "SPACE_ID" in os.environ:
         if os.environ["SPACE_ID"].split("/")[-1].startswith("comp-"):
             logger.info("Pausing space...")
-            api = HfApi(token=params.token)
+            api = hub.get_api(params.token)
             api.pause_space(repo_id=os.environ["SPACE_ID"])
 
 
 def delete_space(params):
+    hub.flush_commits()
     if "SPACE_ID" in os.environ:
         if os.environ["SPACE_ID"].split("/")[-1].startswith("comp-"):
             logger.info("Deleting space...")
-            api = HfApi(token=params.token)
+            api = hub.get_api(params.token)
             api.delete_repo(repo_id=os.environ["SPACE_ID"], repo_type="space")
 
 
 def download_submission_info(params):
-    user_fname = hf_hub_download(
-        repo_id=params.competition_id,
-        filename=f"submission_info/{params.team_id}.json",
-        token=params.token,
-        repo_type="dataset",
-    )
-    with open(user_fname, "r", encoding="utf-8") as f:
-        user_submission_info = json.load(f)
-
-    return user_submission_info
-
-
-def upload_submission_info(params, user_submission_info):
-    user_submission_info_json = json.dumps(user_submission_info, indent=4)
-    user_submission_info_json_bytes = user_submission_info_json.encode("utf-8")
-    user_submission_info_json_buffer = io.BytesIO(user_submission_info_json_bytes)
-    api = HfApi(token=params.token)
-    api.upload_file(
-        path_or_fileobj=user_submission_info_json_buffer,
-        path_in_repo=f"submission_info/{params.team_id}.json",
-        repo_id=params.competition_id,
-        repo_type="dataset",
-    )
+    return get_state_store(params.competition_id, params.token).get_team_submissions(params.team_id)
+
+
+def update_team_submission(competition_id, team_id, submission_id, token, **fields):
+    """Set `fields` on a submission of a team."""
+    get_state_store(competition_id, token).update_submission(team_id, submission_id, **fields)
 
 
 def update_submission_status(params, status):
-    user_submission_info = download_submission_info(params)
-    for submission in user_submission_info["submissions"]:
-        if submission["submission_id"] == params.submission_id:
-            submission["status"] = status
-            break
-    upload_submission_info(params, user_submission_info)
+    update_team_submission(params.competition_id, params.team_id, params.submission_id, params.token, status=status)
 
 
 def update_submission_score(params, public_score, private_score):
-    user_submission_info = download_submission_info(params)
-    for submission in user_submission_info["submissions"]:
-        if submission["submission_id"] == params.submission_id:
-            submission["public_score"] = public_score
-            submission["private_score"] = private_score
-            submission["status"] = "done"
-            break
-    upload_submission_info(params, user_submission_info)
+    update_team_submission(
+        params.competition_id,
+        params.team_id,
+        params.submission_id,
+        params.token,
+        public_score=public_score,
+        private_score=private_score,
+        status="done",
+    )
 
 
 def monitor(func):
@@ -316,71 +365,32 @@ def is_user_admin(user_token, competition_organization):
     return False
 
 
+def get_team_id(user_token, competition_id, hf_token):
+    user_info = token_information(token=user_token)
+    return get_state_store(competition_id, hf_token).get_user_team(user_info["id"])
+
+
 def get_team_name(user_token, competition_id, hf_token):
     user_info = token_information(token=user_token)
     user_id = user_info["id"]
-    user_team = hf_hub_download(
-        repo_id=competition_id,
-        filename="user_team.json",
-        token=hf_token,
-        repo_type="dataset",
-    )
-    with open(user_team, "r", encoding="utf-8") as f:
-        user_team = json.load(f)
+    state = get_state_store(competition_id, hf_token)
+    team_id = state.get_user_team(user_id)
 
-    if user_id not in user_team:
+    if team_id is None:
         return None
 
-    team_id = user_team[user_id]
-
-    team_metadata = hf_hub_download(
-        repo_id=competition_id,
-        filename="teams.json",
-        token=hf_token,
-        repo_type="dataset",
-    )
-    with open(team_metadata, "r", encoding="utf-8") as f:
-        team_metadata = json.load(f)
-
-    team_name = team_metadata[team_id]["name"]
+    team_name = state.get_teams()[team_id]["name"]
     return team_name
 
 
 def update_team_name(user_token, new_team_name, competition_id, hf_token):
     user_info = token_information(token=user_token)
     user_id = user_info["id"]
-    user_team = hf_hub_download(
-        repo_id=competition_id,
-        filename="user_team.json",
-        token=hf_token,
-        repo_type="dataset",
-    )
-    with open(user_team, "r", encoding="utf-8") as f:
-        user_team = json.load(f)
+    state = get_state_store(competition_id, hf_token)
+    team_id = state.get_user_team(user_id)
 
-    if user_id not in user_team:
+    if team_id is None:
         raise Exception("User is not part of a team")
 
-    team_id = user_team[user_id]
-
-    team_metadata = hf_hub_download(
-        repo_id=competition_id,
-        filename="teams.json",
-        token=hf_token,
-        repo_type="dataset",
-    )
-    with open(team_metadata, "r", encoding="utf-8") as f:
-        team_metadata = json.load(f)
-
-    team_metadata[team_id]["name"] = new_team_name
-    team_metadata_json = json.dumps(team_metadata, indent=4)
-    team_metadata_json_bytes = team_metadata_json.encode("utf-8")
-    team_metadata_json_buffer = io.BytesIO(team_metadata_json_bytes)
-    api = HfApi(token=hf_token)
-    api.upload_file(
-        path_or_fileobj=team_metadata_json_buffer,
-        path_in_repo="teams.json",
-        repo_id=competition_id,
-        repo_type="dataset",
-    )
+    state.rename_team(team_id, new_team_name)
     return new_team_name
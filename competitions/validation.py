@@ -0,0 +1,56 @@
+import io
+import os
+
+import pandas as pd
+
+from competitions.errors import SubmissionError
+from competitions.formats import iter_submission, read_columns
+from competitions.solution import IdCoverage
+
+
+VALIDATION_CHUNK_SIZE = int(os.environ.get("VALIDATION_CHUNK_SIZE", 100_000))
+
+
+def validate_submission(data, fmt, submission_cols, submission_rows=None, solution=None):
+    """
+    Validate an uploaded submission in a single pass over chunks of at most `VALIDATION_CHUNK_SIZE` rows.
+
+    Checks that every column of `submission_cols` is present and that the file has `submission_rows` rows. If the
+    solution is given, the ids have to cover the solution ids exactly once and the scored columns cannot have missing
+    values, or values that are not numbers where the solution targets are numeric.
+    Raises `SubmissionError` for the first problem found.
+    """
+    columns = read_columns(data, fmt)
+    missing_cols = [col for col in submission_cols if col not in columns]
+    if missing_cols:
+        raise SubmissionError(f"Submission is missing columns: {', '.join(missing_cols)}")
+
+    coverage = IdCoverage(solution.index) if solution is not None else None
+    # predictions have to be numbers only where the targets are, labels of a classification can be strings
+    numeric_cols = set()
+    if solution is not None:
+        numeric_cols = {
+            col for col in solution.target_cols if pd.api.types.is_numeric_dtype(solution.public_targets[col].dtype)
+        }
+    usecols = list(dict.fromkeys(submission_cols + ([solution.id_col] if solution is not None else [])))
+    num_rows = 0
+    try:
+        for chunk in iter_submission(io.BytesIO(data), fmt, usecols, VALIDATION_CHUNK_SIZE):
+            num_rows += len(chunk)
+            if submission_rows is not None and num_rows > submission_rows:
+                raise SubmissionError(f"Submission has more than {submission_rows} rows")
+            if solution is None:
+                continue
+            coverage.update(chunk[solution.id_col].to_numpy())
+            for col in solution.target_cols:
+                if col in numeric_cols and pd.to_numeric(chunk[col], errors="coerce").isna().any():
+                    raise SubmissionError(f"Column {col} has missing or non-numeric values")
+                if chunk[col].isna().any():
+                    raise SubmissionError(f"Column {col} has missing values")
+    except (ValueError, KeyError) as e:
+        raise SubmissionError(f"Could not read {fmt} submission: {e}") from e
+
+    if submission_rows is not None and num_rows != submission_rows:
+        raise SubmissionError(f"Submission has {num_rows} rows, expected {submission_rows}")
+    if coverage is not None:
+        coverage.check()
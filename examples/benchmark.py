@@ -0,0 +1,217 @@
+"""
+Benchmark the leaderboard, evaluation and submission paths on a fake competition, without network.
+
+The competition is generated with generate_fake_submissions.py and served from a local directory with
+HUB_LOCAL_DIR. The results are written as json, with the min, median, mean and max duration of every measurement
+in seconds, so that runs can be compared across versions.
+
+    python examples/benchmark.py --num_teams 1000 --num_submissions 10 --num_rows 100000 --output results.json
+
+Other settings are read from the environment as usual, e.g. STATE_BACKEND=sqlite benchmarks the local state store.
+The competitions package has to be importable, installed with `pip install -e .` or from the repo root with
+`PYTHONPATH=. python examples/benchmark.py`.
+"""
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from generate_fake_submissions import METRICS, generate_competition, generate_submission, user_token
+
+
+COMPETITION_ID = "benchmark/competition"
+BENCHMARK_TOKEN = "hf_benchmark"
+
+
+def measure(name, func, repeat, warmup=1, setup=None):
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        func()
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start_time)
+    result = {
+        "name": name,
+        "repeat": repeat,
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "mean": statistics.mean(durations),
+        "max": max(durations),
+    }
+    print(json.dumps(result), file=sys.stderr)
+    return result
+
+
+def run(args, hub_dir):
+    # the competition modules read their settings when imported
+    os.environ["HUB_LOCAL_DIR"] = hub_dir
+    os.environ["COMPETITION_ID"] = COMPETITION_ID
+    os.environ["HF_TOKEN"] = BENCHMARK_TOKEN
+    os.environ.setdefault("LEADERBOARD_CACHE_DIR", os.path.join(hub_dir, "leaderboard"))
+    os.environ.setdefault("STATE_DB_DIR", os.path.join(hub_dir, "state"))
+    os.environ.setdefault("OUTPUT_PATH", os.path.join(hub_dir, "output"))
+    for key in ("OAUTH_CLIENT_ID", "OAUTH_CLIENT_SECRET", "OAUTH_SCOPES"):
+        os.environ.setdefault(key, "benchmark")
+    os.environ.setdefault("OPENID_PROVIDER_URL", "https://huggingface.co")
+
+    from loguru import logger
+
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level="WARNING")
+
+    from competitions import hub, leaderboard
+    from competitions.compute_metrics import compute_metrics
+    from competitions.info import get_competition_info
+    from competitions.params import EvalParams
+    from competitions.runner import JobRunner
+
+    start_time = time.perf_counter()
+    repo_dir = os.path.join(hub_dir, "datasets", COMPETITION_ID)
+    generate_competition(
+        repo_dir,
+        num_teams=args.num_teams,
+        num_submissions=args.num_submissions,
+        num_rows=args.num_rows,
+        pending_fraction=args.pending_fraction,
+        seed=args.seed,
+    )
+    logger.warning(f"Generated the competition in {time.perf_counter() - start_time:.2f} seconds")
+
+    results = []
+    competition_info = get_competition_info(COMPETITION_ID, BENCHMARK_TOKEN)
+    lb = leaderboard.Leaderboard(
+        end_date=competition_info.end_date,
+        eval_higher_is_better=competition_info.eval_higher_is_better,
+        max_selected_submissions=competition_info.selection_limit,
+        competition_id=COMPETITION_ID,
+        token=BENCHMARK_TOKEN,
+        scoring_metric=competition_info.scoring_metric,
+    )
+
+    def drop_leaderboard():
+        leaderboard._MATERIALIZED_LEADERBOARDS.clear()
+        shutil.rmtree(leaderboard.LEADERBOARD_CACHE_DIR, ignore_errors=True)
+
+    for split in ("public", "private"):
+        private = split == "private"
+        results.append(
+            measure(
+                f"leaderboard_fetch_{split}_cold",
+                lambda: lb.fetch(private=private),
+                args.repeat,
+                setup=drop_leaderboard,
+            )
+        )
+        results.append(measure(f"leaderboard_fetch_{split}_warm", lambda: lb.fetch(private=private), args.repeat))
+
+    rng = np.random.default_rng(args.seed)
+    solution = pd.read_csv(os.path.join(repo_dir, "solution.csv"))
+    submission_files = {metric: generate_submission(solution, metric, rng) for metric in METRICS}
+    for metric in METRICS:
+        hub.upload(COMPETITION_ID, f"submissions/benchmark-{metric}.csv", submission_files[metric], BENCHMARK_TOKEN)
+        params = EvalParams(
+            competition_id=COMPETITION_ID,
+            competition_type="generic",
+            metric=metric,
+            token=BENCHMARK_TOKEN,
+            team_id="benchmark",
+            submission_id=metric,
+            submission_id_col="id",
+            submission_cols=["id", "target"],
+            submission_rows=args.num_rows,
+            output_path=os.environ["OUTPUT_PATH"],
+            submission_repo="",
+            time_limit=3600,
+            dataset="",
+            submission_filenames=["submission.csv"],
+        )
+        results.append(measure(f"compute_metrics_{metric}", lambda: compute_metrics(params), args.repeat))
+
+    runner = JobRunner(competition_id=COMPETITION_ID, token=BENCHMARK_TOKEN, output_path=os.environ["OUTPUT_PATH"])
+    results.append(measure("get_pending_subs", runner.get_pending_subs, args.repeat))
+    runner.shutdown()
+
+    from fastapi.testclient import TestClient
+
+    from competitions import app as competitions_app
+    from competitions.app import app
+
+    # importing the app starts its job runner, which is stopped so that scoring does not run during the measurements
+    competitions_app.stop_job_runner()
+    client = TestClient(app)
+    requests_made = [0]
+
+    def new_submission():
+        i = requests_made[0] % args.num_teams
+        requests_made[0] += 1
+        response = client.post(
+            "/new_submission",
+            files={"submission_file": ("submission.csv", submission_files[competition_info.metric])},
+            data={"hub_model": "none", "submission_comment": "benchmark"},
+            headers={"Authorization": f"Bearer {user_token(i)}"},
+        )
+        if not response.json().get("response", "").startswith("Success"):
+            raise RuntimeError(f"Submission failed: {response.text}")
+
+    results.append(measure("new_submission", new_submission, args.repeat))
+    hub.flush_commits()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num_teams", type=int, default=1000)
+    parser.add_argument("--num_submissions", type=int, default=10, help="submissions per team")
+    parser.add_argument("--num_rows", type=int, default=10_000, help="rows of the solution")
+    parser.add_argument("--pending_fraction", type=float, default=0.01, help="fraction of pending submissions")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of every measurement")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--hub_dir", default=None, help="directory of the local hub, a temporary one by default")
+    parser.add_argument("--output", default=None, help="json file to write the results to, stdout by default")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    hub_dir = args.hub_dir or tempfile.mkdtemp(prefix="competitions-benchmark-")
+    if os.path.exists(os.path.join(hub_dir, "datasets", COMPETITION_ID)):
+        parser.error(f"{hub_dir} already has a benchmark competition, use an empty directory")
+    if args.hub_dir is None:
+        # registered before the competition modules are imported, so that it runs after their exit handlers
+        atexit.register(shutil.rmtree, hub_dir, ignore_errors=True)
+    results = run(args, hub_dir)
+
+    from competitions import __version__
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "verbose", "hub_dir")},
+        "environment": {
+            "competitions": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "state_backend": os.environ.get("STATE_BACKEND", "hub"),
+        },
+        "results": results,
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=4))
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,161 @@
+"""
+Generate a fake generic competition, with a solution and the teams and submissions of the competition state.
+
+The competition repo is written to a local directory. It can be served without network with HUB_LOCAL_DIR, see
+`competitions/local_hub.py`, or uploaded to the hub with
+`huggingface-cli upload <competition_id> <output> --repo-type dataset`.
+
+    python examples/generate_fake_submissions.py --output /tmp/hub/datasets/org/competition --num_teams 1000
+
+The users of the teams are the local hub users of the tokens `hf_fake_<i>`.
+"""
+import argparse
 import io
 import json
 import os
 import random
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
 
-from huggingface_hub import HfApi
-from tqdm import tqdm
+import numpy as np
+import pandas as pd
 
+from competitions.enums import SubmissionStatus
+from competitions.local_hub import local_user
 
-NUM_USERS = 1000
-NUM_SUBMISSIONS = 10
-MIN_SCORE = 0.0
-MAX_SCORE = 1.0
-START_DATE = datetime(2022, 1, 1, 0, 0, 0)
-END_DATE = datetime(2022, 11, 23, 0, 0, 0)
-COMPETITION_ID = os.environ.get("COMPETITION_ID")
-AUTOTRAIN_TOKEN = os.environ.get("AUTOTRAIN_TOKEN")
 
-if __name__ == "__main__":
-    # example submission:
-    # {"name": "abhishek", "id": "5fa19f4ba13e063b8b2b5e11", "submissions": [{"date": "2022-11-09", "time": "12:54:55", "submission_id": "c0eed646-838f-482f-bf4d-2c651f8de43b", "submission_comment": "", "status": "pending", "selected": true, "public_score": -1, "private_score": -1}, {"date": "2022-11-09", "time": "14:02:21", "submission_id": "bc6b08c2-c684-4ee1-9be2-35cf717ce618", "submission_comment": "", "status": "done", "selected": true, "public_score": 0.3333333333333333, "private_score": 0.3333333333333333}, {"date": "2022-11-17", "time": "21:31:04", "submission_id": "4a2984b1-de10-411d-be0f-9aa7be16245f", "submission_comment": "", "status": "done", "selected": false, "public_score": 0.3333333333333333, "private_score": 0.3333333333333333}]}
-
-    for i in tqdm(range(NUM_USERS)):
-        name = f"test_{i}"
-        # generate random id
-        id = "".join(random.choices("0123456789abcdef", k=24))
-        submissions = []
-        for j in range(NUM_SUBMISSIONS):
-            date = START_DATE + (END_DATE - START_DATE) * random.random()
-            time = date.strftime("%H:%M:%S")
-            date = date.strftime("%Y-%m-%d")
-            submission_id = "".join(random.choices("0123456789abcdef", k=36))
-            submission_comment = ""
-            status = "done"
-            selected = False
-            public_score = MIN_SCORE + (MAX_SCORE - MIN_SCORE) * random.random()
-            private_score = MIN_SCORE + (MAX_SCORE - MIN_SCORE) * random.random()
-            submission = {
-                "date": date,
-                "time": time,
-                "submission_id": submission_id,
-                "submission_comment": submission_comment,
-                "status": status,
-                "selected": selected,
-                "public_score": public_score,
-                "private_score": private_score,
-            }
-            submissions.append(submission)
+# built-in metrics, scored from predicted labels or from predicted probabilities
+LABEL_METRICS = ["accuracy_score", "f1_score"]
+SCORE_METRICS = ["roc_auc_score", "mean_squared_error", "mean_absolute_error", "r2_score"]
+METRICS = LABEL_METRICS + SCORE_METRICS
+LOWER_IS_BETTER_METRICS = ["mean_squared_error", "mean_absolute_error"]
+DAYS = 30
+
 
-        submission = {
-            "name": name,
-            "id": id,
-            "submissions": submissions,
+def user_token(i):
+    return f"hf_fake_{i}"
+
+
+def generate_solution(num_rows, rng):
+    return pd.DataFrame(
+        {
+            "id": np.arange(num_rows),
+            "target": rng.integers(0, 2, num_rows),
+            "split": np.where(rng.random(num_rows) < 0.5, "public", "private"),
         }
-        fname = f"{id}.json"
-        user_submission_info_json = json.dumps(submission)
-        user_submission_info_json_bytes = user_submission_info_json.encode("utf-8")
-        user_submission_info_json_buffer = io.BytesIO(user_submission_info_json_bytes)
-        api = HfApi()
-        api.upload_file(
-            path_or_fileobj=user_submission_info_json_buffer,
-            path_in_repo=fname,
-            repo_id=COMPETITION_ID,
-            repo_type="dataset",
-            token=AUTOTRAIN_TOKEN,
+    )
+
+
+def generate_submission(solution, metric, rng):
+    """Predictions for `solution`, right about 80% of the time, as csv bytes."""
+    scores = np.clip(solution["target"] * 0.6 + rng.random(len(solution)) * 0.5, 0, 1)
+    submission = pd.DataFrame({"id": solution["id"], "target": scores})
+    if metric in LABEL_METRICS:
+        submission["target"] = (scores > 0.5).astype(int)
+    buffer = io.BytesIO()
+    submission.to_csv(buffer, index=False)
+    return buffer.getvalue()
+
+
+def _team_submissions(team_id, user_id, num_submissions, selection_limit, pending_fraction, metric, now):
+    submissions = []
+    for _ in range(num_submissions):
+        submission_datetime = now - timedelta(seconds=random.randint(0, DAYS * 24 * 3600))
+        status = SubmissionStatus.PENDING if random.random() < pending_fraction else SubmissionStatus.SUCCESS
+        submissions.append(
+            {
+                "datetime": submission_datetime.strftime("%Y-%m-%d %H:%M:%S"),
+                "submission_id": str(uuid.uuid4()),
+                "submission_comment": "",
+                "submission_repo": "",
+                "space_id": "",
+                "submitted_by": user_id,
+                "status": status.value,
+                "selected": False,
+                "public_score": {metric: random.random()} if status == SubmissionStatus.SUCCESS else {},
+                "private_score": {metric: random.random()} if status == SubmissionStatus.SUCCESS else {},
+            }
+        )
+    for submission in random.sample(submissions, min(random.randint(0, selection_limit), len(submissions))):
+        submission["selected"] = True
+    submissions.sort(key=lambda sub: sub["datetime"])
+    return {"id": team_id, "submissions": submissions}
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+
+
+def generate_competition(
+    output,
+    num_teams,
+    num_submissions,
+    num_rows,
+    metric="accuracy_score",
+    pending_fraction=0.0,
+    submission_limit=1000,
+    selection_limit=2,
+    seed=42,
+):
+    random.seed(seed)
+    rng = np.random.default_rng(seed)
+    now = datetime.now()
+    os.makedirs(output, exist_ok=True)
+
+    conf = {
+        "COMPETITION_TYPE": "generic",
+        "SUBMISSION_LIMIT": submission_limit,
+        "SELECTION_LIMIT": selection_limit,
+        "END_DATE": (now + timedelta(days=DAYS)).strftime("%Y-%m-%d"),
+        "EVAL_HIGHER_IS_BETTER": 0 if metric in LOWER_IS_BETTER_METRICS else 1,
+        "SUBMISSION_ID_COLUMN": "id",
+        "SUBMISSION_COLUMNS": "id,target",
+        "SUBMISSION_ROWS": num_rows,
+        "EVAL_METRIC": metric,
+        "LOGO": "",
+        "TIME_LIMIT": 3600,
+    }
+    _write_json(os.path.join(output, "conf.json"), conf)
+    for filename in ("COMPETITION_DESC.md", "DATASET_DESC.md", "SUBMISSION_DESC.md", "RULES.md"):
+        with open(os.path.join(output, filename), "w", encoding="utf-8") as f:
+            f.write(f"# {filename[:-3].replace('_', ' ').title()}\n\nFake competition for benchmarks.\n")
+    generate_solution(num_rows, rng).to_csv(os.path.join(output, "solution.csv"), index=False)
+
+    user_team = {}
+    teams = {}
+    for i in range(num_teams):
+        team_id = str(uuid.uuid4())
+        user_id, user_name = local_user(user_token(i))
+        user_team[user_id] = team_id
+        teams[team_id] = {"id": team_id, "name": user_name, "members": [user_id], "leader": user_id}
+        submission_info = _team_submissions(
+            team_id, user_id, num_submissions, selection_limit, pending_fraction, metric, now
         )
+        _write_json(os.path.join(output, "submission_info", f"{team_id}.json"), submission_info)
+    _write_json(os.path.join(output, "user_team.json"), user_team)
+    _write_json(os.path.join(output, "teams.json"), teams)
+    return conf
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", required=True, help="directory of the competition repo")
+    parser.add_argument("--num_teams", type=int, default=1000)
+    parser.add_argument("--num_submissions", type=int, default=10, help="submissions per team")
+    parser.add_argument("--num_rows", type=int, default=10_000, help="rows of the solution")
+    parser.add_argument("--metric", default="accuracy_score", choices=METRICS)
+    parser.add_argument("--pending_fraction", type=float, default=0.0, help="fraction of pending submissions")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    generate_competition(
+        args.output,
+        num_teams=args.num_teams,
+        num_submissions=args.num_submissions,
+        num_rows=args.num_rows,
+        metric=args.metric,
+        pending_fraction=args.pending_fraction,
+        seed=args.seed,
+    )